@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import re
+import hashlib
+import logging
+from pathlib import Path
+
+from typing import Iterable, Optional, Pattern, Set
+
+log = logging.getLogger('knitj.blob')
+
+BLOB_NAME = re.compile(r'[0-9a-f]{64}\.(png|svg)')
+
+
+def collect_unreferenced(
+    path: Path,
+    pattern: Pattern[str],
+    documents: Iterable[Path],
+    before: float,
+) -> int:
+    # files created since `before` may belong to a document not written yet
+    if not path.exists():
+        return 0
+    reference = re.compile(f'{re.escape(path.name)}/({pattern.pattern})')
+    referenced: Set[str] = set()
+    for document in documents:
+        try:
+            text = document.read_text()
+        except (FileNotFoundError, UnicodeDecodeError):
+            continue
+        referenced.update(m.group(1) for m in reference.finditer(text))
+    n_removed = 0
+    for entry in path.iterdir():
+        if (
+            pattern.fullmatch(entry.name)
+            and entry.name not in referenced
+            and entry.stat().st_mtime < before
+        ):
+            entry.unlink()
+            n_removed += 1
+    if n_removed:
+        log.info(f'Removed {n_removed} unreferenced files from {path}')
+    return n_removed
+
+
+class BlobStore:
+    def __init__(self, path: Path, threshold: int = 1 << 14) -> None:
+        self._path = path
+        self._threshold = threshold
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def threshold(self) -> int:
+        return self._threshold
+
+    def put(self, data: bytes, ext: str) -> str:
+        name = f'{hashlib.sha256(data).hexdigest()}.{ext}'
+        path = self._path / name
+        if not path.exists():
+            self._path.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f'.{name}.tmp')
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+            log.info(f'Stored blob {name[:6]} ({len(data)} bytes)')
+        return f'blob/{name}'
+
+    def collect(self, documents: Iterable[Path], before: float) -> None:
+        collect_unreferenced(self._path, BLOB_NAME, documents, before)
+
+    def get_path(self, name: str) -> Optional[Path]:
+        if not BLOB_NAME.fullmatch(name):
+            return None
+        path = self._path / name
+        return path if path.exists() else None
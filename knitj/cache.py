@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import json
+import time
+import shutil
+import logging
+from pathlib import Path
+
+from .cell import Hash
+
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+log = logging.getLogger('knitj.cache')
+
+
+def default_cache_dir() -> Path:
+    root = os.environ.get('XDG_CACHE_HOME')
+    return (Path(root) if root else Path.home() / '.cache') / 'knitj'
+
+
+def chain_hashes(hashids: Iterable[Hash], seed: str = '') -> Iterator[Hash]:
+    key = Hash.from_string(seed)
+    for hashid in hashids:
+        key = Hash.from_string(key.value + hashid.value)
+        yield key
+
+
+class DiskCache:
+    def __init__(
+        self, path: Path, max_size: int = 1 << 30, max_age: float = 30 * 86400
+    ) -> None:
+        self._path = path
+        self._max_size = max_size
+        self._max_age = max_age
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def _entry(self, key: Hash) -> Path:
+        return self._path / key.value
+
+    def get_text(self, key: Hash) -> Optional[str]:
+        path = self._entry(key)
+        try:
+            text = path.read_text()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return text
+
+    def set_text(self, key: Hash, text: str) -> None:
+        path = self._entry(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'.{path.name}.tmp')
+        tmp.write_text(text)
+        os.replace(tmp, path)
+
+    def clear(self) -> None:
+        if self._path.exists():
+            shutil.rmtree(self._path)
+        log.info(f'Cleared cache in {self._path}')
+
+    def evict(self) -> None:
+        if not self._path.exists():
+            return
+        now = time.time()
+        entries = []
+        for path in self._path.iterdir():
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort(reverse=True)
+        size, n_evicted = 0, 0
+        for mtime, entry_size, path in entries:
+            if size + entry_size > self._max_size or now - mtime > self._max_age:
+                path.unlink()
+                n_evicted += 1
+            else:
+                size += entry_size
+        if n_evicted:
+            log.info(f'{n_evicted} entries evicted from {self._path}')
+
+
+class ExecutionCache(DiskCache):
+    def get(self, key: Hash) -> Optional[Dict[str, Any]]:
+        text = self.get_text(key)
+        if text is None:
+            return None
+        state: Dict[str, Any] = json.loads(text)
+        return state
+
+    def set(self, key: Hash, state: Dict[str, Any]) -> None:
+        self.set_text(key, json.dumps(state))
+
+
+class RenderCache(DiskCache):
+    def __init__(
+        self,
+        path: Path,
+        fingerprint: str,
+        max_size: int = 1 << 28,
+        max_age: float = 30 * 86400,
+    ) -> None:
+        super().__init__(path, max_size, max_age)
+        self._fingerprint = fingerprint
+
+    def _entry(self, key: Hash) -> Path:
+        return super()._entry(Hash.from_string(self._fingerprint + key.value))
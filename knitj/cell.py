@@ -2,23 +2,27 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import re
+import base64
 import hashlib
 import html
 import asyncio
+import functools
 from abc import ABC, abstractmethod
-from typing import Dict, Optional, Set
-
-from misaka import Markdown, HtmlRenderer
-import pygments
-from pygments.formatters import HtmlFormatter
-from pygments.lexers import PythonLexer
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, TYPE_CHECKING
 
 from .jupyter_messaging.content import MIME
+from .render import RenderJob, markdown, highlight, ansi_to_html
+from .blob import BlobStore
+from .stream import StreamBuffer, elision_marker
+from .spill import SpillStore, SpillLog
+
+if TYPE_CHECKING:
+    from .cache import RenderCache  # noqa: F401
 
 
-_md = Markdown(
-    HtmlRenderer(), extensions='fenced-code math math-explicit tables quote'.split()
-)
+_render_cache: Optional['RenderCache'] = None
+_blob_store: Optional[BlobStore] = None
+_spill_store: Optional[SpillStore] = None
 
 
 class Hash:
@@ -48,6 +52,88 @@ class Hash:
         return cls(hashlib.sha1(s.encode()).hexdigest())
 
 
+def set_render_cache(cache: Optional['RenderCache']) -> None:
+    global _render_cache
+    _render_cache = cache
+
+
+def cached_render(hashid: Hash, render: Callable[[], str]) -> str:
+    html = lookup_render(hashid)
+    if html is None:
+        html = store_render(hashid, render())
+    return html
+
+
+def lookup_render(hashid: Hash) -> Optional[str]:
+    return _render_cache.get_text(hashid) if _render_cache else None
+
+
+def store_render(hashid: Hash, html: str) -> str:
+    if _render_cache:
+        _render_cache.set_text(hashid, html)
+    return html
+
+
+def set_blob_store(store: Optional[BlobStore]) -> None:
+    global _blob_store
+    _blob_store = store
+
+
+def blob_url(data: str, ext: str, decode: Callable[[str], bytes]) -> Optional[str]:
+    if _blob_store is None or len(data) < _blob_store.threshold:
+        return None
+    return _blob_store.put(decode(data), ext)
+
+
+def set_spill_store(store: Optional[SpillStore]) -> None:
+    global _spill_store
+    _spill_store = store
+
+
+def spill_output(output: Dict[MIME, str]) -> Dict[MIME, str]:
+    store = _spill_store
+    if store is None:
+        return output
+    spilled = [
+        (mime, ext)
+        for mime, ext in [(MIME.TEXT_HTML, 'html'), (MIME.TEXT_PLAIN, 'txt')]
+        if len(output.get(mime, '')) > store.threshold
+    ]
+    if not spilled:
+        return output
+    preview = output.get(MIME.TEXT_PLAIN) or output[MIME.TEXT_HTML]
+    links = ', '.join(
+        f'<a href="{store.put(output[mime], ext)}" target="_blank">'
+        f'{mime.value} ({len(output[mime])} characters)</a>'
+        for mime, ext in spilled
+    )
+    return {
+        **{
+            mime: data
+            for mime, data in output.items()
+            if mime not in {MIME.TEXT_HTML, MIME.TEXT_PLAIN}
+        },
+        MIME.TEXT_HTML: (
+            f'<pre>{html.escape(preview[: store.preview])}</pre>'
+            f'<p class="spilled">Output truncated, full output: {links}</p>'
+        ),
+    }
+
+
+def parse_modeline(modeline: str) -> Tuple[Set[str], Dict[str, str]]:
+    flags: Set[str] = set()
+    options: Dict[str, str] = {}
+    for token in modeline.split():
+        key, sep, value = token.partition('=')
+        if sep:
+            options[re.sub(r'[^a-z_]', '', key)] = value
+            continue
+        flag = re.sub(r'[^a-z]', '', token)
+        if flag:
+            flags.add(flag)
+    return flags, options
+
+
 class BaseCell(ABC):
     def __init__(self, content: str) -> None:
         self._html: Optional[str] = None
@@ -67,6 +153,9 @@ class BaseCell(ABC):
     def to_html(self) -> str:
         ...
 
+    def render_jobs(self) -> List[RenderJob]:
+        return []
+
 
 class TextCell(BaseCell):
     def __init__(self, content: str) -> None:
@@ -77,7 +166,20 @@ class TextCell(BaseCell):
         return f'<TextCell hashid={self.hashid!r} content={self._content!r}>'
 
     def to_html(self) -> str:
-        return f'<div class="{self.hashid.value} text-cell">{_md(self._content)}</div>'
+        return cached_render(self.hashid, lambda: self._wrap(markdown(self._content)))
+
+    def _wrap(self, body: str) -> str:
+        return f'<div class="{self.hashid.value} text-cell">{body}</div>'
+
+    def render_jobs(self) -> List[RenderJob]:
+        if self._html is None:
+            self._html = lookup_render(self.hashid)
+        if self._html is not None:
+            return []
+        return [RenderJob(markdown, self._content, self._set_markdown)]
+
+    def _set_markdown(self, body: str) -> None:
+        self._html = store_render(self.hashid, self._wrap(body))
 
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, BaseCell):
@@ -94,14 +196,22 @@ class CodeCell(BaseCell):
                 modeline, code = code[m.end() :].split('\n', 1)
             except ValueError:
                 modeline, code = code, ''
-            modeline = re.sub(r'[^a-z]', '', modeline)
-            self.flags = set(modeline.split())
+            self.flags, self.options = parse_modeline(modeline)
         else:
-            self.flags = set()
+            self.flags, self.options = set(), {}
         self._code = code
+        self._code_html: Optional[str] = None
+        self._output_html: Optional[str] = None
         self._output: Optional[Dict[MIME, str]] = None
         self._error: Optional[str] = None
-        self._stream = ''
+        self._traceback: Optional[str] = None
+        self._stream_log: Optional[SpillLog] = None
+        self._stream_url: Optional[str] = None
+        self._stream = self._new_stream()
+        # counts writes to the stream, browsers apply a delta only on top of
+        # the write it was computed from
+        self._stream_seq = 0
+        self._stream_delta: Optional[Tuple[str, bool, int]] = None
         self._done = asyncio.get_event_loop().create_future()
         self._flags: Set[str] = set()
 
@@ -120,6 +230,18 @@ class CodeCell(BaseCell):
     def code(self) -> str:
         return self._code
 
+    @property
+    def kernel(self) -> Optional[str]:
+        return self.options.get('kernel')
+
+    @property
+    def failed(self) -> bool:
+        return self._error is not None or self._traceback is not None
+
+    @property
+    def aborted(self) -> bool:
+        return 'aborted' in self._flags
+
     def update_flags(self, other: 'CodeCell') -> bool:
         update = self.flags != other.flags
         if update:
@@ -127,36 +249,133 @@ class CodeCell(BaseCell):
             self._html = None
         return update
 
+    def _new_stream(self) -> StreamBuffer:
+        return StreamBuffer(on_elide=self._spill_line if _spill_store else None)
+
+    def _spill_line(self, line: str) -> None:
+        if self._stream_log is None:
+            assert _spill_store
+            self._stream_log = _spill_store.open_log()
+            self._stream_url = self._stream_log.url
+        self._stream_log.write(f'{line}\n')
+
     def append_stream(self, s: str) -> None:
-        if s[0] == '\r':
-            self._stream = '\n'.join(self._stream.split('\n')[:-1])
+        appendable = bool(self._stream)
+        rewrite = s[0] == '\r'
+        if rewrite:
             s = s[1:]
-        self._stream += s
+        exact = self._stream.write(s, rewrite)
+        base, self._stream_seq = self._stream_seq, self._stream_seq + 1
+        self._stream_delta = (s, rewrite, base) if appendable and exact else None
+        self._output_html = None
         self._html = None
 
+    @property
+    def stream_seq(self) -> int:
+        return self._stream_seq
+
+    def pop_stream_delta(self) -> Optional[Tuple[str, bool, int]]:
+        delta, self._stream_delta = self._stream_delta, None
+        return delta
+
     def set_output(self, output: Dict[MIME, str]) -> None:
-        self._output = output
+        self._output = spill_output(output)
+        self._stream_delta = None
+        self._output_html = None
         self._html = None
 
     def set_error(self, error: str) -> None:
         self._error = error
+        self._traceback = None
+        self._output_html = None
+        self._html = None
+
+    def set_traceback(self, traceback: str) -> None:
+        self._traceback = traceback
+        self._output_html = None
+        self._html = None
+
+    def _flush_traceback(self) -> None:
+        if self._traceback is not None:
+            self.set_error(ansi_to_html(self._traceback))
+
+    def render_jobs(self) -> List[RenderJob]:
+        jobs = []
+        if self._code_html is None:
+            self._code_html = lookup_render(self.hashid)
+        if self._code_html is None:
+            jobs.append(RenderJob(highlight, self._code, self._set_code_html))
+        if self._traceback is not None:
+            done = functools.partial(self._set_traceback_html, self._traceback)
+            jobs.append(RenderJob(ansi_to_html, self._traceback, done))
+        return jobs
+
+    def _set_traceback_html(self, traceback: str, error: str) -> None:
+        if self._traceback == traceback:
+            self.set_error(error)
+
+    def _set_code_html(self, code_html: str) -> None:
+        self._code_html = store_render(self.hashid, code_html)
+        self._html = None
+
+    def dump(self) -> Dict[str, Any]:
+        self._flush_traceback()
+        return {
+            'output': (
+                {mime.value: data for mime, data in self._output.items()}
+                if self._output is not None
+                else None
+            ),
+            'stream': str(self._stream),
+            'error': self._error,
+        }
+
+    def load(self, state: Dict[str, Any]) -> None:
+        output = state['output']
+        self._output = (
+            {MIME(mime): data for mime, data in output.items()}
+            if output is not None
+            else None
+        )
+        self._stream.clear()
+        self._stream.write(state['stream'])
+        self._stream_seq += 1
+        self._error = state['error']
+        self._traceback = None
+        self._output_html = None
         self._html = None
 
     def reset(self) -> None:
         self._output = None
         self._error = None
-        self._stream = ''
+        self._traceback = None
+        if self._stream_log:
+            self._stream_log.close()
+            self._stream_log = None
+        self._stream_url = None
+        self._stream = self._new_stream()
+        self._stream_seq += 1
+        self._stream_delta = None
+        self._output_html = None
         self._html = None
         self._flags.discard('done')
+        self._flags.discard('aborted')
         self._done = asyncio.get_event_loop().create_future()
 
     def set_done(self) -> None:
         self._flags.discard('evaluating')
         self._flags.add('done')
         self._html = None
+        if self._stream_log:
+            self._stream_log.close()
+            self._stream_log = None
         if not self.done():
             self._done.set_result(None)
 
+    def set_aborted(self) -> None:
+        self._flags.add('aborted')
+        self.set_done()
+
     def done(self) -> bool:
         return self._done.done()
 
@@ -164,18 +383,35 @@ class CodeCell(BaseCell):
         await self._done
 
     def to_html(self) -> str:
-        code = pygments.highlight(self._code, PythonLexer(), HtmlFormatter())
+        if self._code_html is None:
+            self._code_html = cached_render(self.hashid, lambda: highlight(self._code))
+        if self._output_html is None:
+            self._output_html = self._render_output()
+        content = (
+            f'<div class="code">{self._code_html}</div>'
+            f'<div class="output">{self._output_html}</div>'
+        )
+        classes = [self.hashid.value, 'code-cell']
+        classes.extend(self.flags)
+        classes.extend(self._flags)
+        return f'<div class="{" ".join(classes)}">{content}</div>'
+
+    def _render_output(self) -> str:
+        self._flush_traceback()
         if self._output is None:
             output = ''
         elif MIME.IMAGE_SVG_XML in self._output:
             m = re.search(r'<svg', self._output[MIME.IMAGE_SVG_XML])
             assert m
             output = self._output[MIME.IMAGE_SVG_XML][m.start() :]
+            url = blob_url(output, 'svg', str.encode)
+            if url:
+                output = f'<img alt="" src="{url}"/>'
         elif MIME.IMAGE_PNG in self._output:
+            png = self._output[MIME.IMAGE_PNG]
+            url = blob_url(png, 'png', base64.b64decode)
             output = (
-                '<img alt="" src="data:image/png;base64,'
-                + self._output[MIME.IMAGE_PNG]
-                + '"/>'
+                '<img alt="" src="' + (url or 'data:image/png;base64,' + png) + '"/>'
             )
         elif MIME.TEXT_HTML in self._output:
             output = self._output[MIME.TEXT_HTML]
@@ -186,12 +422,20 @@ class CodeCell(BaseCell):
         if self._error:
             output = '<pre>' + self._error + '</pre>' + output
         if self._stream:
-            output = '<pre>' + html.escape(self._stream) + '</pre>' + output
-        content = f'<div class="code">{code}</div><div class="output">{output}</div>'
-        classes = [self.hashid.value, 'code-cell']
-        classes.extend(self.flags)
-        classes.extend(self._flags)
-        return f'<div class="{" ".join(classes)}">{content}</div>'
+            output = (
+                f'<pre class="stream" data-seq="{self._stream_seq}">'
+                f'{self._render_stream()}</pre>{output}'
+            )
+        return output
+
+    def _render_stream(self) -> str:
+        head, n_elided, tail = self._stream.parts()
+        if not n_elided:
+            return html.escape(head + tail)
+        marker = elision_marker(n_elided)
+        if self._stream_url:
+            marker = f'<a href="{self._stream_url}" target="_blank">{marker}</a>'
+        return f'{html.escape(head)}{marker}\n{html.escape(tail)}'
 
 
 class JinjaCell(CodeCell):
@@ -201,4 +445,4 @@ class JinjaCell(CodeCell):
         self._template = template
 
     def append_stream(self, s: str) -> None:
-        super().set_output({MIME.TEXT_HTML: _md(s)})
+        super().set_output({MIME.TEXT_HTML: markdown(s)})
@@ -0,0 +1,199 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import asyncio
+import logging
+from pathlib import Path
+
+from .cache import DiskCache
+from .cell import Hash, CodeCell
+from .kernel import KernelPool
+from . import jupyter_messaging as jupy
+
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+log = logging.getLogger('knitj.checkpoint')
+
+# executed in an IPython kernel; unless dill is installed, which pickles
+# everything by value, functions defined in the document are saved as source
+# and classes defined in the document are skipped along with their instances
+_save_source = """\
+def _knitj_save(path):
+    import os, types, inspect
+    try:
+        import dill as pickle
+    except ImportError:
+        import pickle
+    ip = get_ipython()
+    modules, sources, values, skipped = {}, {}, {}, []
+    for name, value in ip.user_ns.items():
+        if name.startswith('_') or name in ip.user_ns_hidden:
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+        elif (
+            pickle.__name__ == 'pickle'
+            and isinstance(value, types.FunctionType)
+            and value.__module__ == '__main__'
+        ):
+            try:
+                sources[name] = inspect.getsource(value)
+            except (OSError, TypeError):
+                skipped.append(name)
+        elif pickle.__name__ == 'pickle' and '__main__' in (
+            getattr(value, '__module__', None), type(value).__module__
+        ):
+            skipped.append(name)
+        else:
+            values[name] = value
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            pickle.dump((modules, sources), f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(values, f, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        for name, value in list(values.items()):
+            try:
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                skipped.append(name)
+                del values[name]
+        with open(tmp, 'wb') as f:
+            pickle.dump((modules, sources), f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(values, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    print(f'saved {len(modules) + len(sources) + len(values)} names')
+    if skipped:
+        print(f'skipped {", ".join(sorted(skipped))}')
+"""
+
+_restore_source = """\
+def _knitj_restore(path):
+    import importlib
+    try:
+        import dill as pickle
+    except ImportError:
+        import pickle
+    ns = get_ipython().user_ns
+    with open(path, 'rb') as f:
+        modules, sources = pickle.load(f)
+        for name, module in modules.items():
+            ns[name] = importlib.import_module(module)
+        for source in sources.values():
+            exec(source, ns)
+        values = pickle.load(f)
+    ns.update(values)
+    print(f'restored {len(modules) + len(sources) + len(values)} names')
+"""
+
+
+def save_code(path: Path) -> str:
+    return _save_source + f'_knitj_save({str(path)!r})\ndel _knitj_save\n'
+
+
+def restore_code(path: Path) -> str:
+    return _restore_source + f'_knitj_restore({str(path)!r})\ndel _knitj_restore\n'
+
+
+class CheckpointStore(DiskCache):
+    def __init__(
+        self, path: Path, max_size: int = 1 << 34, max_age: float = 7 * 86400
+    ) -> None:
+        super().__init__(path, max_size, max_age)
+
+    def get_path(self, key: Hash) -> Optional[Path]:
+        path = self._entry(key)
+        if not path.exists():
+            return None
+        os.utime(path)
+        return path
+
+    def new_path(self, key: Hash) -> Path:
+        self._path.mkdir(parents=True, exist_ok=True)
+        return self._entry(key)
+
+
+def checkpoint_due(msg: jupy.Message, cell: CodeCell) -> bool:
+    return (
+        'checkpoint' in cell.flags
+        and isinstance(msg, jupy.STATUS)
+        and msg.content.execution_state == jupy.content.State.IDLE
+        and not cell.failed
+        and not cell.aborted
+    )
+
+
+class CheckpointJobs:
+    def __init__(self, kernel: KernelPool, store: CheckpointStore) -> None:
+        self._kernel = kernel
+        self._store = store
+        self._jobs: Dict[Hash, Tuple[str, 'asyncio.Future[bool]']] = {}
+        self._failed: Set[Hash] = set()
+
+    def __contains__(self, key: Optional[Hash]) -> bool:
+        return key in self._jobs
+
+    def __iter__(self) -> Iterator[Hash]:
+        yield from self._jobs
+
+    def _add(self, action: str, key: Hash) -> 'asyncio.Future[bool]':
+        done = asyncio.get_event_loop().create_future()
+        self._jobs[key] = action, done
+        return done
+
+    def get_path(self, key: Hash) -> Optional[Path]:
+        return self._store.get_path(key)
+
+    def save(self, cell: CodeCell, key: Hash) -> 'asyncio.Future[bool]':
+        log.info(f'{cell.hashid}: Saving checkpoint {key}')
+        done = self._add('save', key)
+        self._kernel.execute_next(
+            key, save_code(self._store.new_path(key)), cell.kernel, silent=True
+        )
+        return done
+
+    def restore(
+        self, key: Hash, path: Path, group: Optional[str]
+    ) -> 'asyncio.Future[bool]':
+        log.info(f'Restoring checkpoint {key}')
+        done = self._add('restore', key)
+        self._kernel.execute(key, restore_code(path), group, silent=True)
+        return done
+
+    def abort(self, key: Hash) -> None:
+        action, done = self._jobs.pop(key)
+        self._failed.discard(key)
+        log.warning(f'Checkpoint {key}: {action} aborted')
+        done.set_result(False)
+
+    def clear(self) -> None:
+        for _, done in self._jobs.values():
+            done.cancel()
+        self._jobs.clear()
+        self._failed.clear()
+
+    async def wait_for_saves(self) -> None:
+        await asyncio.gather(
+            *(done for action, done in self._jobs.values() if action == 'save')
+        )
+
+    def process_message(self, msg: jupy.Message, key: Hash) -> None:
+        action, done = self._jobs[key]
+        if isinstance(msg, jupy.STREAM):
+            for line in msg.content.text.splitlines():
+                log.info(f'Checkpoint {key}: {line}')
+        elif isinstance(msg, jupy.ERROR):
+            log.warning(
+                f'Checkpoint {key}: {action} failed: '
+                f'{msg.content.ename}: {msg.content.evalue}'
+            )
+            self._failed.add(key)
+        elif (
+            isinstance(msg, jupy.STATUS)
+            and msg.content.execution_state == jupy.content.State.IDLE
+        ):
+            del self._jobs[key]
+            failed = key in self._failed
+            self._failed.discard(key)
+            done.set_result(not failed)
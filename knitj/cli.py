@@ -1,7 +1,9 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
 import sys
+import time
 import argparse
 import asyncio
 from pathlib import Path
@@ -11,10 +13,16 @@ from contextlib import contextmanager
 
 import webbrowser
 
-from typing import Optional, Iterator, IO
+from typing import Optional, Iterator, IO, Tuple, List
 
 from .server import KnitjServer
 from .convert import convert
+from .cache import ExecutionCache, RenderCache, default_cache_dir
+from .cell import set_render_cache, set_blob_store, set_spill_store
+from .render import RENDER_FINGERPRINT, Renderer
+from .blob import BlobStore
+from .spill import SpillStore
+from .checkpoint import CheckpointStore
 
 logging.basicConfig(
     style='{',
@@ -28,11 +36,66 @@ log.setLevel(logging.INFO)
 def parse_cli() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     arg = parser.add_argument
-    arg('source', type=Path, metavar='FILE', nargs='?', help='input file')
+    arg(
+        'source',
+        type=Path,
+        metavar='FILE',
+        nargs='*',
+        help='input files or directories of input files',
+    )
     arg('-s', '--server', action='store_true', help='run in server mode')
     arg('-f', '--format', help='input format')
     arg('-o', '--output', type=Path, metavar='FILE', help='output HTML file')
+    arg(
+        '-d',
+        '--output-dir',
+        type=Path,
+        metavar='DIR',
+        help='directory for output HTML files of multiple inputs',
+    )
+    arg(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        metavar='N',
+        help='number of documents converted concurrently',
+    )
     arg('-k', '--kernel', help='Jupyter kernel to use')
+    arg(
+        '--kernel-channels',
+        choices=['thread', 'zmq'],
+        default='thread',
+        help='how to receive kernel messages',
+    )
+    arg(
+        '--existing',
+        type=Path,
+        metavar='CONNECTION_FILE',
+        help='connect to a running kernel instead of starting one',
+    )
+    arg(
+        '--in-flight',
+        type=int,
+        default=1,
+        metavar='N',
+        help='number of execution requests sent to a kernel ahead of time',
+    )
+    arg(
+        '--interrupt-stale',
+        action='store_true',
+        help='interrupt cells removed from the source while evaluating',
+    )
+    arg(
+        '--rerun-dependents',
+        action='store_true',
+        help='also rerun cells that use names defined by changed cells',
+    )
+    arg(
+        '--spare-kernel',
+        action='store_true',
+        help='keep a booted spare kernel for instant restarts',
+    )
     arg('-b', '--browser', help='browser to open')
     arg(
         '-n',
@@ -41,52 +104,282 @@ def parse_cli() -> argparse.Namespace:
         action='store_false',
         help='do not open a browser',
     )
+    arg(
+        '--blobs',
+        action='store_true',
+        help='write large images and outputs next to the output instead of '
+        'inlining them',
+    )
+    arg('-c', '--cache', action='store_true', help='cache outputs of code cells')
+    arg('--cache-dir', type=Path, metavar='DIR', help='cache directory')
+    arg('--clear-cache', action='store_true', help='clear cache before running')
+    arg(
+        '--no-render-cache',
+        dest='render_cache',
+        action='store_false',
+        help='do not cache rendered HTML of cells',
+    )
+    arg(
+        '--render-workers',
+        type=int,
+        metavar='N',
+        help='render HTML in N worker processes instead of a thread',
+    )
     args = parser.parse_args()
-    if args.server and args.source is None:
-        parser.error('argument -s/--server: requires input file')
+    args.batch = bool(
+        args.output_dir or len(args.source) > 1 or any(p.is_dir() for p in args.source)
+    )
+    if args.server and (args.batch or not args.source):
+        parser.error('argument -s/--server: requires a single input file')
+    if args.batch and args.output:
+        parser.error('argument -o/--output: not allowed with multiple inputs')
+    if args.batch and args.existing:
+        parser.error('argument --existing: not allowed with multiple inputs')
+    if args.jobs < 1:
+        parser.error('argument -j/--jobs: must be positive')
+    if args.in_flight < 1:
+        parser.error('argument --in-flight: must be positive')
+    if args.render_workers is not None and args.render_workers < 1:
+        parser.error('argument --render-workers: must be positive')
     return args
 
 
+def init_caches(
+    args: argparse.Namespace,
+) -> Tuple[ExecutionCache, Optional[RenderCache], CheckpointStore]:
+    cache_dir = args.cache_dir or default_cache_dir()
+    cache = ExecutionCache(cache_dir / 'outputs')
+    render_cache = RenderCache(cache_dir / 'html', RENDER_FINGERPRINT)
+    checkpoints = CheckpointStore(cache_dir / 'checkpoints')
+    if args.clear_cache:
+        cache.clear()
+        render_cache.clear()
+        checkpoints.clear()
+    if not args.render_cache:
+        return cache, None, checkpoints
+    set_render_cache(render_cache)
+    return cache, render_cache, checkpoints
+
+
+def detect_format(fmt: Optional[str], source: Optional[Path]) -> str:
+    if fmt:
+        return fmt
+    if source:
+        if source.suffix == '.py':
+            return 'python'
+        if source.suffix == '.md':
+            return 'markdown'
+    raise RuntimeError('Cannot determine input format')
+
+
 def main() -> None:
     args = parse_cli()
     log.info('Entered Knitj')
-    fmt: Optional[str] = None
-    if args.format:
-        fmt = args.format
-    elif args.source:
-        if args.source.suffix == '.py':
-            fmt = 'python'
-        elif args.source.suffix == '.md':
-            fmt = 'markdown'
-    if not fmt:
-        raise RuntimeError('Cannot determine input format')
-    if args.browser is not False:
-        browser: Optional[webbrowser.BaseBrowser] = webbrowser.get(args.browser)
-    else:
-        browser = None
+    cache, render_cache, checkpoints = init_caches(args)
     loop = asyncio.get_event_loop()
-    # hack to catch exceptions from kernel channels that run in threads
-    executor = concurrent.futures.ThreadPoolExecutor()
+    # hack to catch exceptions from kernel channels that run in threads,
+    # not needed with --kernel-channels=zmq
+    executor = concurrent.futures.ThreadPoolExecutor(executor_workers(args))
     loop.set_default_executor(executor)
+    renderer = Renderer(args.render_workers)
+    n_failed = 0
     if args.server:
-        assert args.source
-        if args.output:
-            output = args.output
-        else:
-            output = args.source.with_suffix('.html')
-        app = KnitjServer(args.source, output, fmt, browser, args.kernel)
-        loop.run_until_complete(app.start())
-        try:
-            loop.run_forever()
-        except KeyboardInterrupt:
-            pass
-        loop.run_until_complete(app.cleanup())
+        run_server(args, loop, renderer, checkpoints)
+    elif args.batch:
+        n_failed = run_batch(
+            args, loop, cache if args.cache else None, renderer, checkpoints
+        )
     else:
-        with maybe_input(args.source) as source, maybe_output(args.output) as output:
-            loop.run_until_complete(convert(source, output, fmt, args.kernel))
+        run_single(args, loop, cache if args.cache else None, renderer, checkpoints)
     executor.shutdown(wait=True)
+    renderer.shutdown()
     loop.close()
+    if render_cache:
+        render_cache.evict()
+    checkpoints.evict()
     log.info('Leaving Knitj')
+    if n_failed:
+        sys.exit(1)
+
+
+def executor_workers(args: argparse.Namespace) -> int:
+    # kernels on thread channels each keep two threads polling, kernel
+    # starts, restarts and shutdowns need threads on top of that
+    n_polling = 0
+    if args.kernel_channels == 'thread':
+        n_polling = 2 * (args.jobs if args.batch else 1)
+    return n_polling + min(32, (os.cpu_count() or 1) + 4)
+
+
+def run_server(
+    args: argparse.Namespace,
+    loop: asyncio.AbstractEventLoop,
+    renderer: Renderer,
+    checkpoints: CheckpointStore,
+) -> None:
+    source = args.source[0]
+    fmt = detect_format(args.format, source)
+    if args.browser is not False:
+        browser: Optional[webbrowser.BaseBrowser] = webbrowser.get(args.browser)
+    else:
+        browser = None
+    output = args.output or source.with_suffix('.html')
+    started = time.time()
+    blobs: Optional[BlobStore] = None
+    spills: Optional[SpillStore] = None
+    if args.blobs:
+        blobs = BlobStore(output.parent / 'blob')
+        set_blob_store(blobs)
+        spills = SpillStore(output.parent / 'spill')
+        set_spill_store(spills)
+    app = KnitjServer(
+        source,
+        output,
+        fmt,
+        browser,
+        args.kernel,
+        channels=args.kernel_channels,
+        interrupt_stale=args.interrupt_stale,
+        rerun_dependents=args.rerun_dependents,
+        blobs=blobs,
+        spills=spills,
+        spare_kernel=args.spare_kernel,
+        existing=args.existing,
+        window=args.in_flight,
+        checkpoints=checkpoints if args.cache else None,
+        renderer=renderer,
+    )
+    loop.run_until_complete(app.start())
+    try:
+        loop.run_until_complete(app.run())
+    except KeyboardInterrupt:
+        pass
+    loop.run_until_complete(app.cleanup())
+    documents = output_documents(output.parent)
+    if blobs:
+        blobs.collect(documents, started)
+    if spills:
+        spills.collect(documents, started)
+
+
+def run_single(
+    args: argparse.Namespace,
+    loop: asyncio.AbstractEventLoop,
+    cache: Optional[ExecutionCache],
+    renderer: Renderer,
+    checkpoints: CheckpointStore,
+) -> None:
+    source = args.source[0] if args.source else None
+    fmt = detect_format(args.format, source)
+    started = time.time()
+    blobs: Optional[BlobStore] = None
+    if args.blobs:
+        output_dir = args.output.parent if args.output else Path()
+        blobs = BlobStore(output_dir / 'blob')
+        set_blob_store(blobs)
+    with maybe_input(source) as f_in, maybe_output(args.output) as f_out:
+        loop.run_until_complete(
+            convert(
+                f_in,
+                f_out,
+                fmt,
+                args.kernel,
+                cache=cache,
+                channels=args.kernel_channels,
+                existing=args.existing,
+                window=args.in_flight,
+                renderer=renderer,
+                checkpoints=checkpoints if cache else None,
+            )
+        )
+    # output written to stdout cannot be checked for references
+    if blobs and args.output:
+        blobs.collect(output_documents(args.output.parent), started)
+
+
+def run_batch(
+    args: argparse.Namespace,
+    loop: asyncio.AbstractEventLoop,
+    cache: Optional[ExecutionCache],
+    renderer: Renderer,
+    checkpoints: CheckpointStore,
+) -> int:
+    tasks = batch_tasks(args.source, args.output_dir)
+    blobs: Optional[BlobStore] = None
+    if args.blobs:
+        if not args.output_dir:
+            raise RuntimeError('Option --blobs with multiple inputs needs --output-dir')
+        blobs = BlobStore(args.output_dir / 'blob')
+        set_blob_store(blobs)
+    if args.output_dir:
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+    semaphore = asyncio.Semaphore(args.jobs)
+
+    async def convert_one(source: Path, output: Path) -> Tuple[float, bool]:
+        async with semaphore:
+            log.info(f'Converting {source}')
+            start = time.time()
+            try:
+                with source.open() as f_in, output.open('w') as f_out:
+                    await convert(
+                        f_in,
+                        f_out,
+                        detect_format(args.format, source),
+                        args.kernel,
+                        cache=cache,
+                        channels=args.kernel_channels,
+                        existing=args.existing,
+                        window=args.in_flight,
+                        renderer=renderer,
+                        checkpoints=checkpoints if cache else None,
+                    )
+            except Exception:
+                log.exception(f'Conversion of {source} failed')
+                return time.time() - start, False
+            return time.time() - start, True
+
+    start = time.time()
+    results = loop.run_until_complete(
+        asyncio.gather(*(convert_one(source, output) for source, output in tasks))
+    )
+    log.info(f'Converted {len(tasks)} documents in {time.time() - start:.1f}s:')
+    for (source, _), (elapsed, ok) in zip(tasks, results):
+        log.info(f'{elapsed:8.1f}s  {"ok" if ok else "FAILED":6}  {source}')
+    if blobs:
+        blobs.collect(args.output_dir.rglob('*.html'), start)
+    return sum(not ok for _, ok in results)
+
+
+def output_documents(directory: Path) -> List[Path]:
+    return [*directory.glob('*.html'), *directory.glob('*.knitj')]
+
+
+def batch_tasks(
+    sources: List[Path], output_dir: Optional[Path]
+) -> List[Tuple[Path, Path]]:
+    inputs: List[Path] = []
+    for path in sources:
+        if path.is_dir():
+            inputs.extend(
+                sorted(p for p in path.iterdir() if p.suffix in {'.py', '.md'})
+            )
+        else:
+            inputs.append(path)
+    tasks = [
+        (
+            path,
+            (
+                output_dir / path.with_suffix('.html').name
+                if output_dir
+                else path.with_suffix('.html')
+            ),
+        )
+        for path in inputs
+    ]
+    outputs = [output for _, output in tasks]
+    if len(set(outputs)) < len(outputs):
+        raise RuntimeError('Several inputs map to the same output file')
+    return tasks
 
 
 @contextmanager
@@ -27,6 +27,8 @@ function elemFromHtml(html) {
 
 const ws = new WebSocket(`ws://${document.location.host}/ws`);
 let askedForRestart = false;
+// cells whose full HTML was requested after a stream delta did not fit
+const staleCells = new Set();
 
 function send(msg) {
   ws.send(JSON.stringify(msg));
@@ -71,6 +73,68 @@ function appendReevaluate(cell) {
   }));
 }
 
+function requestCell(hashid) {
+  if (!staleCells.has(hashid)) {
+    staleCells.add(hashid);
+    send({ kind: 'get_cell', hashid });
+  }
+}
+
+function appendStream(cell, msg) {
+  const { text, rewrite } = msg;
+  const output = cell.getElementsByClassName('output')[0];
+  const pre = output.querySelector(':scope > pre.stream');
+  const seq = pre ? Number(pre.dataset.seq) : -1;
+  if (seq >= msg.seq) {
+    // already contained in the HTML this browser got
+    return;
+  }
+  if (seq !== msg.base) {
+    requestCell(msg.hashid);
+    return;
+  }
+  pre.dataset.seq = msg.seq;
+  if (rewrite) {
+    // text arrives escaped, cutting the markup at a newline keeps the
+    // link of an elision marker, which never spans lines
+    const content = pre.innerHTML;
+    pre.innerHTML = content.slice(0, content.lastIndexOf('\n') + 1);
+  }
+  pre.insertAdjacentHTML('beforeend', text);
+}
+
+function prepareCell(cell) {
+  if (cell.classList.contains('code-cell')) {
+    appendReevaluate(cell);
+  } else if (cell.classList.contains('text-cell')) {
+    renderMath(cell);
+  }
+  return cell;
+}
+
+function applyPatch(ops) {
+  const cellsEl = document.getElementById('cells');
+  ops.forEach((op) => {
+    const arr = Array.from(cellsEl.getElementsByClassName(op.hashid));
+    if (op.op === 'delete') {
+      arr.forEach((cell) => { cell.remove(); });
+    } else if (op.op === 'update') {
+      arr.forEach((cell) => { cell.replaceWith(prepareCell(elemFromHtml(op.html))); });
+    } else {
+      const cell = op.op === 'insert' ? prepareCell(elemFromHtml(op.html)) : arr[0];
+      if (!cell) {
+        return;
+      }
+      const after = op.after && cellsEl.getElementsByClassName(op.after)[0];
+      if (after) {
+        after.after(cell);
+      } else {
+        cellsEl.prepend(cell);
+      }
+    }
+  });
+}
+
 function ensureVisible(elem) {
   const rect = elem.getBoundingClientRect();
   const height = window.innerHeight || document.documentElement.clientHeight;
@@ -82,6 +146,7 @@ function ensureVisible(elem) {
 ws.onmessage = ({ data }) => {
   const msg = JSON.parse(data);
   if (msg.kind === 'cell') {
+    staleCells.delete(msg.hashid);
     const cell = elemFromHtml(msg.html);
     const arr = Array.from(document.getElementsByClassName(msg.hashid));
     if (arr.length === 1) {
@@ -97,27 +162,18 @@ ws.onmessage = ({ data }) => {
       });
       ensureVisible(cloned);
     }
-  } else if (msg.kind === 'document') {
-    const cellsEl = h('div', (div) => { div.id = 'cells'; });
-    msg.hashids.forEach((hashid) => {
-      const html = msg.htmls[hashid];
-      let cell;
-      if (html) {
-        cell = elemFromHtml(html);
-        if (cell.classList.contains('code-cell')) {
-          appendReevaluate(cell);
-        } else if (cell.classList.contains('text-cell')) {
-          renderMath(cell);
-        }
-      } else {
-        cell = document.getElementsByClassName(hashid)[0];
-        if (!cell) {
-          cell = cellsEl.getElementsByClassName(hashid)[0].cloneNode(true);
-        }
-      }
-      cellsEl.appendChild(cell);
-    });
-    document.getElementById('cells').replaceWith(cellsEl);
+  } else if (msg.kind === 'stream_append') {
+    if (staleCells.has(msg.hashid)) {
+      return;
+    }
+    const arr = Array.from(document.getElementsByClassName(msg.hashid));
+    arr.forEach((cell) => { appendStream(cell, msg); });
+    if (arr.length > 0) {
+      ensureVisible(arr[arr.length - 1]);
+    }
+  } else if (msg.kind === 'patch') {
+    msg.ops.forEach((op) => { staleCells.delete(op.hashid); });
+    applyPatch(msg.ops);
   } else if (msg.kind === 'kernel_starting') {
     if (askedForRestart) {
       askedForRestart = false;
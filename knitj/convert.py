@@ -2,8 +2,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 from pathlib import Path
+import asyncio
 import logging
 from itertools import chain
+from functools import lru_cache
 from pkg_resources import resource_string
 
 import ansi2html
@@ -11,55 +13,232 @@ import jinja2
 from pygments.formatters import HtmlFormatter
 from pygments.styles import get_style_by_name
 
-from .cell import CodeCell
-from .kernel import Kernel
+from .cell import Hash, CodeCell
+from .cache import ExecutionCache, chain_hashes
+from .kernel import KernelPool
 from .document import Document
 from .parser import Parser
+from .render import Renderer
+from .checkpoint import CheckpointStore, CheckpointJobs, checkpoint_due
+from . import jupyter_messaging as jupy
 
-from typing import IO, Optional
+from typing import IO, Any, Dict, List, Optional, Set, Tuple
 
 log = logging.getLogger('knitj.knitj')
 
 
-def render_index(
-    title: str, cells: str, client: bool = True, template: Path = None
-) -> str:
-    if template:
-        index = template.read_text()
-    else:
-        index = resource_string('knitj', 'client/templates/index.html').decode()
-    templ = jinja2.Template(index)
-    styles = '\n'.join(
+_CELLS = '\x00cells\x00'
+
+
+@lru_cache(maxsize=None)
+def get_styles() -> str:
+    return '\n'.join(
         chain(
             [HtmlFormatter(style=get_style_by_name('trac')).get_style_defs()],
             map(str, ansi2html.style.get_styles()),
         )
     )
-    return templ.render(title=title, cells=cells, styles=styles, client=client)
 
 
-async def convert(
-    source: IO[str], output: IO[str], fmt: str, kernel_name: str = None
+@lru_cache(maxsize=8)
+def _compile_template(
+    template: Optional[Path], mtime: Optional[float]
+) -> jinja2.Template:
+    if template:
+        index = template.read_text()
+    else:
+        index = resource_string('knitj', 'client/templates/index.html').decode()
+    templ: jinja2.Template = jinja2.Template(index)
+    return templ
+
+
+@lru_cache(maxsize=32)
+def _index_fragments(
+    title: str, client: bool, template: Optional[Path], mtime: Optional[float]
+) -> Tuple[str, str]:
+    templ = _compile_template(template, mtime)
+    index = templ.render(title=title, cells=_CELLS, styles=get_styles(), client=client)
+    front, _, back = index.partition(_CELLS)
+    return front, back
+
+
+def index_fragments(
+    title: str, client: bool = True, template: Path = None
+) -> Tuple[str, str]:
+    mtime = template.stat().st_mtime if template else None
+    return _index_fragments(title, client, template, mtime)
+
+
+def render_index(
+    title: str, cells: str, client: bool = True, template: Path = None
+) -> str:
+    front, back = index_fragments(title, client, template)
+    return ''.join([front, cells, back])
+
+
+async def convert(  # noqa: C901
+    source: IO[str],
+    output: IO[str],
+    fmt: str,
+    kernel_name: str = None,
+    cache: ExecutionCache = None,
+    channels: str = 'thread',
+    existing: Path = None,
+    window: int = 1,
+    renderer: Renderer = None,
+    checkpoints: CheckpointStore = None,
 ) -> None:
     document = Document(Parser(fmt))
     document.update_from_source(source.read())
-    kernel = Kernel(document.process_message, kernel_name)
-    kernel.start()
-    try:
-        template: Optional[Path] = Path(document.frontmatter['template'])
-    except KeyError:
-        template = None
-    front, back = render_index('', '__CELLS__', client=False, template=template).split(
-        '__CELLS__'
+    key_of: Dict[Hash, Hash] = {}
+    jobs: Optional[CheckpointJobs] = None
+
+    def handler(msg: jupy.Message, hashid: Optional[Hash]) -> None:
+        if jobs and hashid in jobs:
+            assert hashid
+            jobs.process_message(msg, hashid)
+            return
+        cell = document.process_message(msg, hashid)
+        if jobs and cell and checkpoint_due(msg, cell):
+            jobs.save(cell, key_of[cell.hashid])
+
+    def aborted(hashid: Hash) -> None:
+        if jobs and hashid in jobs:
+            jobs.abort(hashid)
+        else:
+            document.abort(hashid)
+
+    kernel = KernelPool(
+        handler,
+        kernel_name,
+        channels,
+        existing=existing,
+        window=window,
+        aborted=aborted,
     )
-    output.write(front)
-    for _, cell in document.items():
-        if isinstance(cell, CodeCell):
-            kernel.execute(cell.hashid, cell.code)
-    log.info('Code cells submitted to kernel')
-    for _, cell in document.items():
-        if isinstance(cell, CodeCell):
-            await cell.wait_for()
-        output.write(cell.html)
-    output.write(back)
-    await kernel.cleanup()
+    if checkpoints and not existing:
+        jobs = CheckpointJobs(kernel, checkpoints)
+    try:
+        kernel.set_groups(document.frontmatter.get('kernels', {}))
+        kernel.set_stop_on_error(bool(document.frontmatter.get('stop_on_error', False)))
+        code_cells = [cell for cell in document if isinstance(cell, CodeCell)]
+        key_of.update(cache_keys(code_cells, kernel))
+        try:
+            template: Optional[Path] = Path(document.frontmatter['template'])
+        except KeyError:
+            template = None
+        front, back = index_fragments('', client=False, template=template)
+        output.write(front)
+        loaded = await execute_cells(code_cells, key_of, kernel, cache, jobs)
+        if renderer:
+            await renderer.prerender(list(document))
+        for _, cell in document.items():
+            if isinstance(cell, CodeCell):
+                await cell.wait_for()
+                if renderer:
+                    await renderer.prerender([cell])
+                # outputs from a kernel in an unknown state cannot be keyed
+                if cache and not existing and not cell.aborted:
+                    if cell.hashid not in loaded:
+                        cache.set(key_of[cell.hashid], cell.dump())
+            output.write(cell.html)
+        output.write(back)
+        if jobs:
+            await jobs.wait_for_saves()
+    finally:
+        await kernel.cleanup()
+    if cache:
+        cache.evict()
+
+
+async def execute_cells(
+    cells: List[CodeCell],
+    key_of: Dict[Hash, Hash],
+    kernel: KernelPool,
+    cache: Optional[ExecutionCache],
+    jobs: Optional[CheckpointJobs],
+) -> Set[Hash]:
+    def submit(cells: List[CodeCell]) -> None:
+        for cell in cells:
+            barrier = bool(jobs) and 'checkpoint' in cell.flags
+            kernel.execute(cell.hashid, cell.code, cell.kernel, barrier=barrier)
+
+    groups: Dict[Optional[str], List[CodeCell]] = {}
+    for cell in cells:
+        groups.setdefault(cell.kernel, []).append(cell)
+    loaded: Set[Hash] = set()
+    restores: Dict[Optional[str], Tuple[int, 'asyncio.Future[bool]']] = {}
+    for group, group_cells in groups.items():
+        n_cached, path = (
+            load_cached(group_cells, key_of, cache, jobs) if cache else (0, None)
+        )
+        loaded.update(cell.hashid for cell in group_cells[:n_cached])
+        if path:
+            assert jobs
+            key = key_of[group_cells[n_cached - 1].hashid]
+            restores[group] = n_cached, jobs.restore(key, path, group)
+        elif n_cached < len(group_cells):
+            submit(group_cells)
+    for group, (n_cached, restored) in restores.items():
+        group_cells = groups[group]
+        if await restored:
+            submit(group_cells[n_cached:])
+            continue
+        log.warning('Executing from the first cell instead')
+        for cell in group_cells[:n_cached]:
+            cell.reset()
+            loaded.discard(cell.hashid)
+        submit(group_cells)
+    if len(loaded) < len(cells):
+        log.info('Code cells submitted to kernel')
+    return loaded
+
+
+def cache_keys(cells: List[CodeCell], kernel: KernelPool) -> Dict[Hash, Hash]:
+    groups: Dict[Optional[str], List[Hash]] = {}
+    for cell in cells:
+        groups.setdefault(cell.kernel, []).append(cell.hashid)
+    key_of: Dict[Hash, Hash] = {}
+    for group, hashids in groups.items():
+        seed = kernel.kernel_name(group)
+        if group is not None:
+            seed += f':{group}'
+        key_of.update(zip(hashids, chain_hashes(hashids, seed)))
+    return key_of
+
+
+def load_cached(
+    cells: List[CodeCell],
+    key_of: Dict[Hash, Hash],
+    cache: ExecutionCache,
+    jobs: CheckpointJobs = None,
+) -> Tuple[int, Optional[Path]]:
+    states: List[Dict[str, Any]] = []
+    for cell in cells:
+        state = cache.get(key_of[cell.hashid])
+        if state is None:
+            break
+        states.append(state)
+    n_found, path = len(states), None
+    if n_found < len(cells):
+        # the cells after a cached prefix need its namespace, which is only
+        # available from a checkpoint saved at the end of the prefix
+        n_loaded = 0
+        for idx in reversed(range(n_found)):
+            if jobs and 'checkpoint' in cells[idx].flags:
+                path = jobs.get_path(key_of[cells[idx].hashid])
+                if path:
+                    n_loaded = idx + 1
+                    break
+        states = states[:n_loaded]
+    for cell, state in zip(cells, states):
+        cell.load(state)
+        cell.set_done()
+    if len(states) == len(cells):
+        log.info(f'All {len(cells)} code cells loaded from cache')
+    else:
+        log.info(
+            f'{n_found}/{len(cells)} code cells found in cache, '
+            f'{len(states)} loaded'
+        )
+    return len(states), path
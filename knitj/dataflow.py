@@ -0,0 +1,175 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import re
+import ast
+from functools import lru_cache
+
+from .cell import Hash
+
+from typing import Any, Collection, FrozenSet, List, NamedTuple, Optional, Set, Tuple
+
+_magic = re.compile(r'^([ \t]*)(%|!).*$', re.MULTILINE)
+
+# methods that modify their receiver in place
+_mutators = frozenset(
+    """
+    add append appendleft clear difference_update discard extend extendleft
+    fill insert intersection_update pop popitem popleft put remove resize
+    reverse rotate setdefault sort symmetric_difference_update update write
+    """.split()
+)
+
+
+class Names(NamedTuple):
+    defs: FrozenSet[str]
+    uses: FrozenSet[str]
+
+
+class _NameVisitor(ast.NodeVisitor):
+    def __init__(self) -> None:
+        self.defs: Set[str] = set()
+        self.uses: Set[str] = set()
+        self.opaque = False
+
+    def visit_Name(self, node: ast.Name) -> None:
+        if isinstance(node.ctx, ast.Load):
+            self.uses.add(node.id)
+        else:
+            self.defs.add(node.id)
+
+    def _visit_mutated(self, node: ast.AST) -> None:
+        while isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        if isinstance(node, ast.Name):
+            self.defs.add(node.id)
+            self.uses.add(node.id)
+
+    def visit_Attribute(self, node: ast.Attribute) -> None:
+        if not isinstance(node.ctx, ast.Load):
+            self._visit_mutated(node)
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node: ast.Subscript) -> None:
+        if not isinstance(node.ctx, ast.Load):
+            self._visit_mutated(node)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node: ast.AugAssign) -> None:
+        self._visit_mutated(node.target)
+        self.generic_visit(node)
+
+    def visit_Expr(self, node: ast.Expr) -> None:
+        # only known mutators such as `xs.append(x)` or calls with
+        # `inplace=True` count as modifying the receiver, `df.head()` does not
+        call = node.value
+        if isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute):
+            if call.func.attr in _mutators or any(
+                kw.arg == 'inplace' for kw in call.keywords
+            ):
+                self._visit_mutated(call.func.value)
+        self.generic_visit(node)
+
+    def visit_ExceptHandler(self, node: ast.ExceptHandler) -> None:
+        if node.name:
+            self.defs.add(node.name)
+        self.generic_visit(node)
+
+    # capture patterns of match statements, the nodes exist in Python 3.10+
+    def visit_MatchAs(self, node: Any) -> None:
+        if node.name:
+            self.defs.add(node.name)
+        self.generic_visit(node)
+
+    def visit_MatchStar(self, node: Any) -> None:
+        if node.name:
+            self.defs.add(node.name)
+
+    def visit_MatchMapping(self, node: Any) -> None:
+        if node.rest:
+            self.defs.add(node.rest)
+        self.generic_visit(node)
+
+    def visit_Import(self, node: ast.Import) -> None:
+        for alias in node.names:
+            self.defs.add(alias.asname or alias.name.split('.')[0])
+
+    def visit_ImportFrom(self, node: ast.ImportFrom) -> None:
+        for alias in node.names:
+            if alias.name == '*':
+                self.opaque = True
+            self.defs.add(alias.asname or alias.name)
+
+    def _visit_scope(self, nodes: List[Any]) -> None:
+        # names bound in nested scopes are local, but free names are read
+        for node in nodes:
+            for child in ast.walk(node):
+                if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load):
+                    self.uses.add(child.id)
+
+    def visit_FunctionDef(self, node: ast.FunctionDef) -> None:
+        self.defs.add(node.name)
+        for expr in [*node.decorator_list, *node.args.defaults]:
+            self.visit(expr)
+        self._visit_scope(node.body)
+
+    def visit_AsyncFunctionDef(self, node: ast.AsyncFunctionDef) -> None:
+        self.defs.add(node.name)
+        for expr in [*node.decorator_list, *node.args.defaults]:
+            self.visit(expr)
+        self._visit_scope(node.body)
+
+    def visit_ClassDef(self, node: ast.ClassDef) -> None:
+        self.defs.add(node.name)
+        for expr in [*node.decorator_list, *node.bases]:
+            self.visit(expr)
+        self._visit_scope(node.body)
+
+    def visit_Lambda(self, node: ast.Lambda) -> None:
+        self._visit_scope([node])
+
+    def visit_ListComp(self, node: ast.ListComp) -> None:
+        self._visit_scope([node])
+
+    def visit_SetComp(self, node: ast.SetComp) -> None:
+        self._visit_scope([node])
+
+    def visit_DictComp(self, node: ast.DictComp) -> None:
+        self._visit_scope([node])
+
+    def visit_GeneratorExp(self, node: ast.GeneratorExp) -> None:
+        self._visit_scope([node])
+
+
+@lru_cache(maxsize=1024)
+def analyze(code: str) -> Optional[Names]:
+    try:
+        tree = ast.parse(_magic.sub(r'\1pass', code))
+    except SyntaxError:
+        return None
+    visitor = _NameVisitor()
+    visitor.visit(tree)
+    if visitor.opaque:
+        return None
+    return Names(frozenset(visitor.defs), frozenset(visitor.uses))
+
+
+def dependents(cells: List[Tuple[Hash, str]], changed: Collection[Hash]) -> List[Hash]:
+    # cells that cannot be analyzed taint everything below them
+    dirty: Set[str] = set()
+    opaque = False
+    found: List[Hash] = []
+    for hashid, code in cells:
+        names = analyze(code)
+        if hashid not in changed:
+            # a cell that rebinds a dirty name must rerun before its readers
+            if not opaque and not (
+                dirty and (names is None or (names.uses | names.defs) & dirty)
+            ):
+                continue
+            found.append(hashid)
+        if names is None:
+            opaque = True
+        else:
+            dirty.update(names.defs)
+    return found
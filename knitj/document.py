@@ -1,34 +1,81 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import json
 import logging
-from collections import OrderedDict
+from difflib import SequenceMatcher
 
-import ansi2html
 from bs4 import BeautifulSoup
 
 from .parser import Parser
+from . import dataflow
 from . import jupyter_messaging as jupy
 from .jupyter_messaging.content import MIME
 
-from typing import List, Optional, Tuple, Iterator, Dict, Any
+from typing import (
+    List,
+    Optional,
+    Tuple,
+    Iterator,
+    Iterable,
+    Dict,
+    Any,
+    NamedTuple,
+    Set,
+    Collection,
+)
 from .cell import BaseCell, Hash, CodeCell
 
-ansi_convert = ansi2html.Ansi2HTMLConverter().convert
 log = logging.getLogger('knitj.document')
 
 
+class Edit(NamedTuple):
+    kind: str
+    hashid: Hash
+    after: Optional[Hash] = None
+
+
+def diff_hashes(old: List[Hash], new: List[Hash]) -> List[Edit]:
+    n = min(len(old), len(new))
+    lo = 0
+    while lo < n and old[lo] == new[lo]:
+        lo += 1
+    hi = 0
+    while hi < n - lo and old[-hi - 1] == new[-hi - 1]:
+        hi += 1
+    old_mid, new_mid = old[lo : len(old) - hi], new[lo : len(new) - hi]
+    old_set, new_set = set(old_mid), set(new_mid)
+    edits = [Edit('delete', hashid) for hashid in old_mid if hashid not in new_set]
+    kept_old = [hashid for hashid in old_mid if hashid in new_set]
+    kept_new = [hashid for hashid in new_mid if hashid in old_set]
+    stable: Set[Hash] = set()
+    matcher = SequenceMatcher(None, kept_old, kept_new, autojunk=False)
+    for block in matcher.get_matching_blocks():
+        stable.update(kept_new[block.b : block.b + block.size])
+    after = new[lo - 1] if lo else None
+    for hashid in new_mid:
+        if hashid not in old_set:
+            edits.append(Edit('insert', hashid, after))
+        elif hashid not in stable:
+            edits.append(Edit('move', hashid, after))
+        after = hashid
+    return edits
+
+
 class Document:
     def __init__(self, parser: Parser) -> None:
         self._parser = parser
         self._frontmatter: Optional[Dict[str, Any]] = None
-        self._cells: Dict[Hash, BaseCell] = OrderedDict()
+        self._cells: Dict[Hash, BaseCell] = {}
+        self._hashes: List[Hash] = []
 
     def items(self) -> Iterator[Tuple[Hash, BaseCell]]:
-        yield from self._cells.items()
+        for hashid in self._hashes:
+            yield hashid, self._cells[hashid]
 
     def __iter__(self) -> Iterator[BaseCell]:
-        yield from self._cells.values()
+        for hashid in self._hashes:
+            yield self._cells[hashid]
 
     def __getitem__(self, hashid: Hash) -> BaseCell:
         return self._cells[hashid]
@@ -41,11 +88,52 @@ class Document:
         return self._frontmatter.copy() if self._frontmatter is not None else {}
 
     def hashes(self) -> List[Hash]:
-        return list(self._cells)
+        return list(self._hashes)
+
+    def abort(self, hashid: Hash) -> Optional[CodeCell]:
+        cell = self._cells.get(hashid)
+        if not isinstance(cell, CodeCell):
+            return None
+        log.info(f'{hashid}: Execution aborted')
+        cell.set_aborted()
+        return cell
+
+    def dependents(
+        self, hashids: Collection[Hash], previous: List[Tuple[Hash, BaseCell]] = None
+    ) -> List[Hash]:
+        items = list(self.items())
+        changed = set(hashids)
+        if previous:
+            # cells deleted since the previous version still count as changed
+            # at their old position, the names they defined are stale too
+            positions = {hashid: idx for idx, (hashid, _) in enumerate(items)}
+            deleted: Dict[int, List[Tuple[Hash, BaseCell]]] = {}
+            anchor = -1
+            for hashid, cell in previous:
+                if hashid in positions:
+                    anchor = positions[hashid]
+                else:
+                    deleted.setdefault(anchor, []).append((hashid, cell))
+                    changed.add(hashid)
+            merged = deleted.get(-1, [])
+            for idx, item in enumerate(items):
+                merged.append(item)
+                merged.extend(deleted.get(idx, []))
+            items = merged
+        groups: Dict[Optional[str], List[Tuple[Hash, str]]] = {}
+        for hashid, cell in items:
+            if isinstance(cell, CodeCell):
+                groups.setdefault(cell.kernel, []).append((hashid, cell.code))
+        found = {
+            hashid
+            for cells in groups.values()
+            for hashid in dataflow.dependents(cells, changed)
+        }
+        return [hashid for hashid in self._hashes if hashid in found]
 
     def process_message(  # noqa: C901
         self, msg: jupy.Message, hashid: Optional[Hash]
-    ) -> Optional[BaseCell]:
+    ) -> Optional[CodeCell]:
         if not hashid:
             return None
         try:
@@ -65,14 +153,15 @@ class Document:
         elif isinstance(msg, jupy.EXECUTE_REPLY):
             if isinstance(msg.content, jupy.content.ERROR):
                 log.info(f'{hashid}: Got an error execution reply')
-                html = ansi_convert('\n'.join(msg.content.traceback), full=False)
-                cell.set_error(html)
+                cell.set_traceback('\n'.join(msg.content.traceback))
             elif isinstance(msg.content, jupy.content.OK):
                 log.info(f'{hashid}: Got an execution reply')
+            elif isinstance(msg.content, jupy.content.ABORTED):
+                log.info(f'{hashid}: Execution aborted')
+                cell.set_aborted()
         elif isinstance(msg, jupy.ERROR):
             log.info(f'{hashid}: Got an error')
-            html = ansi_convert('\n'.join(msg.content.traceback), full=False)
-            cell.set_error(html)
+            cell.set_traceback('\n'.join(msg.content.traceback))
         elif isinstance(msg, jupy.STATUS):
             if msg.content.execution_state == jupy.content.State.IDLE:
                 log.info(f'{hashid}: Cell done')
@@ -83,6 +172,30 @@ class Document:
             raise ValueError(f'Unknown message type: {type(msg)}')
         return cell
 
+    def dump_state(self) -> Iterator[str]:
+        for hashid, cell in self.items():
+            if isinstance(cell, CodeCell):
+                state = cell.dump()
+                state['done'] = cell.done()
+                state['aborted'] = cell.aborted
+                yield f'{hashid.value} {json.dumps(state)}\n'
+
+    def load_state(self, lines: Iterable[str]) -> None:
+        n_loaded = 0
+        for line in lines:
+            value, _, data = line.partition(' ')
+            cell = self._cells.get(Hash(value))
+            if not isinstance(cell, CodeCell):
+                continue
+            state = json.loads(data)
+            cell.load(state)
+            if state.get('aborted'):
+                cell.set_aborted()
+            elif state['done']:
+                cell.set_done()
+            n_loaded += 1
+        log.info(f'{n_loaded} code cells loaded from state')
+
     def load_output_from_html(self, html: str) -> None:
         soup = BeautifulSoup(html, 'html.parser')
         cells_tag = soup.find(id='cells')
@@ -102,30 +215,41 @@ class Document:
                     cell.flags.add('hide')
         log.info(f'{n_loaded} code cells loaded from output')
 
-    def update_from_source(self, source: str) -> Tuple[List[BaseCell], List[BaseCell]]:
+    def update_from_source(self, source: str) -> Tuple[List[BaseCell], List[Edit]]:
         frontmatter, cell_list = self._parser.parse(source)
         if frontmatter is not None:
             self._frontmatter = frontmatter
-        cells = OrderedDict((cell.hashid, cell) for cell in cell_list)
+        cells: Dict[Hash, BaseCell] = {}
+        updated_flags: List[Edit] = []
+        for cell in cell_list:
+            hashid = cell.hashid
+            if hashid in cells:
+                continue
+            cells[hashid] = cell
+            old_cell = self._cells.get(hashid)
+            if old_cell is None or old_cell is cell:
+                continue
+            if isinstance(old_cell, CodeCell):
+                assert isinstance(cell, CodeCell)
+                if old_cell.update_flags(cell):
+                    updated_flags.append(Edit('update', hashid))
+        hashes = list(cells)
+        edits = diff_hashes(self._hashes, hashes)
         new_cells = []
-        cells_with_updated_flags: List[BaseCell] = []
-        for hashid, cell in cells.items():
-            if hashid in self._cells:
-                old_cell = self._cells[cell.hashid]
-                if isinstance(old_cell, CodeCell):
-                    assert isinstance(cell, CodeCell)
-                    if old_cell.update_flags(cell):
-                        cells_with_updated_flags.append(old_cell)
-            else:
+        n_dropped, n_moved = 0, 0
+        for edit in edits:
+            if edit.kind == 'delete':
+                del self._cells[edit.hashid]
+                n_dropped += 1
+            elif edit.kind == 'insert':
+                cell = cells[edit.hashid]
+                self._cells[edit.hashid] = cell
                 new_cells.append(cell)
-        n_dropped = sum(hashid not in cells for hashid in self._cells)
+            elif edit.kind == 'move':
+                n_moved += 1
+        self._hashes = hashes
         log.info(
             f'File change: {len(new_cells)}/{len(self)} new cells, '
-            f'{n_dropped} dropped'
-        )
-        cells = OrderedDict(
-            (hashid, self._cells.get(hashid, cell)) for hashid, cell in cells.items()
+            f'{n_dropped} dropped, {n_moved} moved'
         )
-        self._cells.clear()
-        self._cells.update(cells)
-        return new_cells, new_cells + cells_with_updated_flags
+        return new_cells, edits + updated_flags
@@ -0,0 +1,170 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import time
+import asyncio
+import logging
+from collections import deque
+
+from .stream import merge_stream_text
+
+from typing import Any, Deque, Dict, Optional
+
+log = logging.getLogger('knitj.flood')
+
+_display_types = {'display_data', 'update_display_data', 'clear_output'}
+
+
+def stream_key(dct: Dict[str, Any]) -> Optional[Any]:
+    if dct['header']['msg_type'] != 'stream':
+        return None
+    return (dct['parent_header'].get('msg_id'), dct['content']['name'])
+
+
+def display_key(dct: Dict[str, Any]) -> Optional[Any]:
+    msg_type = dct['header']['msg_type']
+    if msg_type not in _display_types:
+        return None
+    display_id = dct['content'].get('transient', {}).get('display_id')
+    return (dct['parent_header'].get('msg_id'), msg_type, display_id)
+
+
+def update_id(dct: Dict[str, Any]) -> Optional[str]:
+    if dct['header']['msg_type'] != 'update_display_data':
+        return None
+    display_id: Optional[str] = dct['content'].get('transient', {}).get('display_id')
+    return display_id
+
+
+class MessageQueue:
+    def __init__(
+        self,
+        max_depth: int = 1000,
+        max_chars: int = 1 << 16,
+        max_rate: float = 1 << 20,
+    ) -> None:
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._has_items = asyncio.Event()
+        self._max_depth = max_depth
+        self._max_chars = max_chars
+        self._max_rate = max_rate
+        self._tokens = max_rate
+        self._refilled = time.monotonic()
+        self._suppressed: Dict[Any, Dict[str, Any]] = {}
+        self._n_suppressed: Dict[Any, int] = {}
+        # queued display updates by display ID, later ones replace the content
+        self._updates: Dict[str, Dict[str, Any]] = {}
+        self._n_received = 0
+        self._n_coalesced = 0
+        self._n_dropped = 0
+        self._peak_depth = 0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def put(self, dct: Dict[str, Any]) -> None:
+        self._n_received += 1
+        key = stream_key(dct)
+        if key is not None:
+            if not self._accept_stream(key, dct):
+                return
+        else:
+            key = display_key(dct)
+            if key is not None and not self._accept_display(key, dct):
+                return
+        self._flush_notices()
+        self._append(dct)
+
+    def _accept_stream(self, key: Any, dct: Dict[str, Any]) -> bool:
+        text = dct['content']['text']
+        if not self._take_tokens(len(text)) or len(self._queue) >= self._max_depth:
+            self._suppress(key, dct)
+            return False
+        if key in self._suppressed:
+            return True
+        tail = self._queue[-1] if self._queue else None
+        if tail is None or stream_key(tail) != key:
+            return True
+        merged = merge_stream_text(tail['content']['text'], text)
+        if len(merged) > self._max_chars:
+            return True
+        tail['content'] = {**tail['content'], 'text': merged}
+        self._n_coalesced += 1
+        return False
+
+    def _accept_display(self, key: Any, dct: Dict[str, Any]) -> bool:
+        if len(self._queue) >= self._max_depth:
+            self._suppress(key, dct)
+            return False
+        display_id = update_id(dct)
+        queued = self._updates.get(display_id) if display_id else None
+        if queued is None:
+            return True
+        queued['content'] = dct['content']
+        self._n_coalesced += 1
+        return False
+
+    def _take_tokens(self, n: int) -> bool:
+        now = time.monotonic()
+        self._tokens = min(
+            self._max_rate, self._tokens + (now - self._refilled) * self._max_rate
+        )
+        self._refilled = now
+        # a message larger than the bucket passes once the bucket is full,
+        # the debt then holds back what follows
+        if n > self._tokens and self._tokens < self._max_rate:
+            return False
+        self._tokens -= n
+        return True
+
+    def _suppress(self, key: Any, dct: Dict[str, Any]) -> None:
+        if key not in self._suppressed:
+            log.warning(
+                f'Kernel output flooding, suppressing output messages '
+                f'(queue depth {len(self._queue)})'
+            )
+            self._n_suppressed[key] = 0
+        self._suppressed[key] = dct
+        self._n_suppressed[key] += 1
+        self._n_dropped += 1
+
+    def _flush_notices(self) -> None:
+        for key, dct in self._suppressed.items():
+            if stream_key(dct) is None:
+                # the last display of a flood is kept in place of the others
+                self._n_dropped -= 1
+                self._append(dct)
+                continue
+            n = self._n_suppressed[key]
+            text = f'\n[{n} messages suppressed]\n'
+            self._append({**dct, 'content': {**dct['content'], 'text': text}})
+        self._suppressed.clear()
+        self._n_suppressed.clear()
+
+    def _append(self, dct: Dict[str, Any]) -> None:
+        display_id = update_id(dct)
+        if display_id:
+            self._updates[display_id] = dct
+        self._queue.append(dct)
+        self._peak_depth = max(self._peak_depth, len(self._queue))
+        self._has_items.set()
+
+    async def get(self) -> Dict[str, Any]:
+        while not self._queue:
+            if self._suppressed:
+                self._flush_notices()
+                break
+            self._has_items.clear()
+            await self._has_items.wait()
+        dct = self._queue.popleft()
+        display_id = update_id(dct)
+        if display_id and self._updates.get(display_id) is dct:
+            del self._updates[display_id]
+        return dct
+
+    def log_stats(self) -> None:
+        log.info(
+            f'{self._n_received} kernel messages received, '
+            f'{self._n_coalesced} coalesced, {self._n_dropped} suppressed, '
+            f'peak queue depth {self._peak_depth}'
+        )
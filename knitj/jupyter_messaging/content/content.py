@@ -98,7 +98,7 @@ class ExecuteReplyErrorContent(BaseExecuteReplyContent):
 
 
 class ExecuteReplyAbortedContent(BaseExecuteReplyContent):
-    def __init__(self, *, status: str) -> None:
+    def __init__(self, *, status: str, **kwargs: Any) -> None:
         self.status = Status(status)
 
 
@@ -22,6 +22,7 @@ class MsgType(Enum):
     STATUS = 'status'
     SHUTDOWN_REPLY = 'shutdown_reply'
     SHUTDOWN_REQUEST = 'shutdown_request'
+    INTERRUPT_REQUEST = 'interrupt_request'
 
     def __str__(self) -> str:
         return colstr(self.name, _msg_colors[self])
@@ -4,75 +4,530 @@
 import asyncio
 import logging
 from pprint import pformat
+from collections import deque
 import queue
+from pathlib import Path
 
 import jupyter_client
+import zmq
+import zmq.asyncio
 
 from .cell import Hash
+from .flood import MessageQueue
 from . import jupyter_messaging as jupy
 from .jupyter_messaging import UUID
 
-from typing import Dict, Callable, Optional
+from typing import (
+    Any,
+    Dict,
+    Callable,
+    Optional,
+    List,
+    Awaitable,
+    Deque,
+    Collection,
+    Set,
+    NamedTuple,
+)
 
 log = logging.getLogger('knitj.kernel')
 
+# outputs knitj has no rendering for and the subscription notice of newer
+# kernels, skipped rather than parsed
+_unhandled_types = {'update_display_data', 'clear_output', 'iopub_welcome'}
+
+
+class Request(NamedTuple):
+    hashid: Hash
+    code: str
+    priority: bool = False
+    # nothing else is sent until the request is done
+    barrier: bool = False
+    # internal requests, kept out of the history and execution count
+    silent: bool = False
+
 
 class Kernel:
     def __init__(
         self,
         handler: Callable[[jupy.Message, Optional[Hash]], object],
         kernel: str = None,
+        channels: str = 'thread',
+        spare: bool = False,
+        existing: Path = None,
+        window: int = 1,
+        aborted: Callable[[Hash], object] = None,
+        failed: Callable[[BaseException], object] = None,
     ) -> None:
+        if channels not in {'thread', 'zmq'}:
+            raise ValueError(f'Unknown kernel channels: {channels}')
         self._handler = handler
         self._kernel_name = kernel or 'python3'
+        self._channels_backend = channels
+        self._existing = existing
+        self._spare_enabled = spare and not existing
+        self._window = window
+        self._aborted: Optional[Callable[[Hash], object]] = aborted
+        self._failed: Optional[Callable[[BaseException], object]] = failed
+        self._error: Optional[BaseException] = None
+        self.stop_on_error = False
         self._hashids: Dict[UUID, Hash] = {}
-        self._msg_queue: 'asyncio.Queue[Dict]' = asyncio.Queue()
+        self._pending: Deque[Request] = deque()
+        self._in_flight: Dict[UUID, Request] = {}
+        self._replied: Set[UUID] = set()
+        self._held: Dict[UUID, jupy.Message] = {}
+        # sent requests whose cells are no longer wanted
+        self._superseded: Set[UUID] = set()
+        # sent requests queued in the kernel behind a superseded failure
+        self._retry: Set[UUID] = set()
+        self._requeue: Dict[UUID, Request] = {}
+        self._interrupts: Set[UUID] = set()
+        self._busy: Optional[UUID] = None
+        self._barrier: Optional[UUID] = None
+        self._msg_queue = MessageQueue()
         self._loop = asyncio.get_event_loop()
+        self._ready = False
+        self._probes: List[str] = []
+        self._iopub_up = asyncio.Event()
+        self._starting: Optional[asyncio.Future] = None
+        self._spare: Optional['asyncio.Future[jupyter_client.KernelManager]'] = None
+        self._zmq_context: Optional[zmq.asyncio.Context] = None
+        self._channels: Optional[asyncio.Future] = None
+        self._teardowns: List[asyncio.Future] = []
+
+    @property
+    def name(self) -> str:
+        return self._kernel_name
 
     def start(self) -> None:
-        log.info('Starting kernel...')
-        self._kernel = jupyter_client.KernelManager(kernel_name=self._kernel_name)
-        self._kernel.start_kernel()
-        self._client = self._kernel.client()
+        if self._existing:
+            log.info(f'Connecting to existing kernel {self._existing}...')
+            self._begin(self._activate(self._attach()))
+        else:
+            log.info('Starting kernel...')
+            self._begin(self._activate(self._boot()))
+
+    def _begin(self, starting: Awaitable[None]) -> None:
+        self._starting = asyncio.ensure_future(starting)
+        self._starting.add_done_callback(self._started)
+
+    def _started(self, starting: asyncio.Future) -> None:
+        if starting.cancelled():
+            return
+        error = starting.exception()
+        if not error:
+            return
+        self._error = error
+        log.error(f'Kernel {self._kernel_name} failed to start: {error!r}')
+        self._submit()
+        if self._failed:
+            self._failed(error)
+
+    def _boot(self) -> 'asyncio.Future[jupyter_client.KernelManager]':
+        manager = jupyter_client.KernelManager(kernel_name=self._kernel_name)
+
+        def start() -> jupyter_client.KernelManager:
+            manager.start_kernel()
+            return manager
+
+        return self._loop.run_in_executor(None, start)
+
+    def _attach(self) -> 'asyncio.Future[jupyter_client.KernelManager]':
+        assert self._existing
+
+        def load() -> jupyter_client.KernelManager:
+            path = jupyter_client.find_connection_file(str(self._existing))
+            manager = jupyter_client.KernelManager(connection_file=path)
+            manager.load_connection_file()
+            return manager
+
+        return self._loop.run_in_executor(None, load)
+
+    async def _activate(
+        self, booting: 'asyncio.Future[jupyter_client.KernelManager]'
+    ) -> None:
+        self._kernel = await booting
+        self._connect()
+        await self._wait_for_iopub()
         log.info('Kernel started')
-        self._channels = asyncio.gather(
-            self._receiver(), self._iopub_receiver(), self._shell_receiver()
-        )
+        self._ready = True
+        self._submit()
+        if self._spare_enabled:
+            self._spare = self._boot()
+
+    def _connect(self) -> None:
+        if self._channels_backend == 'zmq':
+            receivers = self._connect_zmq()
+        else:
+            self._client = self._kernel.client()
+            receivers = [self._iopub_receiver(), self._shell_receiver()]
+        self._channels = asyncio.gather(self._receiver(), *receivers)
+
+    def _connect_zmq(self) -> List[Awaitable[None]]:
+        info = self._kernel.get_connection_info()
+        self._session = self._kernel.session
+        self._zmq_context = zmq.asyncio.Context()
+        iopub = self._zmq_context.socket(zmq.SUB)
+        iopub.setsockopt(zmq.SUBSCRIBE, b'')
+        iopub.connect(channel_url(info, 'iopub'))
+        self._shell = self._zmq_context.socket(zmq.DEALER)
+        self._shell.connect(channel_url(info, 'shell'))
+        return [self._zmq_receiver(iopub), self._zmq_receiver(self._shell)]
+
+    async def _wait_for_iopub(self) -> None:
+        if self._channels_backend != 'zmq':
+            return
+        # a SUB socket drops everything until its subscription reaches the
+        # kernel, so probe with kernel info requests until one shows up on
+        # iopub, one at a time and less often while the kernel is slow to start
+        self._iopub_up.clear()
+        self._probes.clear()
+        deadline = self._loop.time() + 60
+        timeout = 0.2
+        while self._loop.time() < deadline:
+            msg_id = self._send_shell('kernel_info_request', {})
+            self._probes.append(msg_id)
+            remaining = deadline - self._loop.time()
+            try:
+                await asyncio.wait_for(self._iopub_up.wait(), min(timeout, remaining))
+            except asyncio.TimeoutError:
+                timeout = min(2 * timeout, 5)
+                continue
+            return
+        log.warning('No kernel status received on iopub, executing anyway')
+
+    async def _teardown(
+        self,
+        manager: jupyter_client.KernelManager,
+        channels: Optional[asyncio.Future],
+        context: Optional[zmq.asyncio.Context],
+    ) -> None:
+        if channels:
+            channels.cancel()
+            try:
+                await channels
+            except asyncio.CancelledError:
+                pass
+        if context:
+            context.destroy(linger=0)
+        if manager.has_kernel:
+            await self._loop.run_in_executor(None, manager.shutdown_kernel)
 
     async def cleanup(self) -> None:
-        self._kernel.shutdown_kernel()
-        self._channels.cancel()
-        try:
-            await self._channels
-        except asyncio.CancelledError:
-            pass
-        log.info('Kernel shut down')
-
-    def restart(self) -> None:
+        error: Optional[BaseException] = None
+        if self._starting:
+            try:
+                await self._starting
+            except Exception as exc:
+                error = exc
+        # a kernel process can outlive a failure in connecting to it
+        manager: Optional[jupyter_client.KernelManager] = getattr(self, '_kernel', None)
+        if manager:
+            await self._teardown(manager, self._channels, self._zmq_context)
+        if self._spare:
+            spare = await self._spare
+            await self._loop.run_in_executor(None, spare.shutdown_kernel)
+        await asyncio.gather(*self._teardowns)
+        self._msg_queue.log_stats()
+        log.info('Disconnected from kernel' if self._existing else 'Kernel shut down')
+        if error:
+            raise error
+
+    def restart(self) -> bool:
+        if not self._ready:
+            log.warning('Kernel is not ready, cannot restart')
+            return False
+        if self._existing:
+            log.warning('Not restarting an existing kernel knitj does not own')
+            return False
         log.info('Restarting kernel')
-        self._kernel.restart_kernel()
+        if self._pending:
+            log.info(f'Dropped {len(self._pending)} queued execution requests')
+        self._pending.clear()
+        self._in_flight.clear()
+        self._replied.clear()
+        self._held.clear()
+        self._superseded.clear()
+        self._retry.clear()
+        self._requeue.clear()
+        self._interrupts.clear()
+        self._busy = None
+        self._barrier = None
+        if self._spare and self._spare.done():
+            self._swap()
+        else:
+            self._ready = False
+            self._begin(self._restart())
+        return True
+
+    async def _restart(self) -> None:
+        await self._loop.run_in_executor(None, self._kernel.restart_kernel)
+        await self._resume()
+
+    async def _resume(self) -> None:
+        await self._wait_for_iopub()
+        self._ready = True
+        self._submit()
+
+    def _swap(self) -> None:
+        assert self._spare
+        self._teardowns.append(
+            asyncio.ensure_future(
+                self._teardown(self._kernel, self._channels, self._zmq_context)
+            )
+        )
+        self._kernel = self._spare.result()
+        self._connect()
+        self._ready = False
+        self._begin(self._resume())
+        self._spare = self._boot()
+        log.info('Switched to the spare kernel')
 
     def interrupt(self) -> None:
+        if not self._ready:
+            return
         log.info('Interrupting kernel')
-        self._kernel.interrupt_kernel()
+        if self._kernel.has_kernel:
+            self._kernel.interrupt_kernel()
+        else:
+            self._send_control('interrupt_request')
 
-    def execute(self, hashid: Hash, code: str) -> None:
-        msg_id = UUID(self._client.execute(code))
+    def _send_control(self, msg_type: str) -> None:
+        socket = zmq.Context.instance().socket(zmq.DEALER)
+        socket.connect(channel_url(self._kernel.get_connection_info(), 'control'))
+        self._kernel.session.send(socket, msg_type, {})
+        socket.close(linger=1000)
+
+    def execute(
+        self,
+        hashid: Hash,
+        code: str,
+        priority: bool = False,
+        barrier: bool = False,
+        silent: bool = False,
+    ) -> None:
+        if priority:
+            idx = next(
+                (i for i, req in enumerate(self._pending) if not req.priority),
+                len(self._pending),
+            )
+            self._pending.insert(idx, Request(hashid, code, True, barrier, silent))
+        else:
+            self._pending.append(Request(hashid, code, False, barrier, silent))
+        self._submit()
+
+    def execute_next(self, hashid: Hash, code: str, silent: bool = False) -> None:
+        self._pending.appendleft(Request(hashid, code, True, silent=silent))
+        self._submit()
+
+    def supersede(self, hashids: Collection[Hash], interrupt: bool = False) -> bool:
+        # returns whether sent requests were superseded, the kernel namespace
+        # then holds effects of cells that are no longer wanted
+        n_pending = len(self._pending)
+        self._pending = deque(req for req in self._pending if req.hashid in hashids)
+        if len(self._pending) < n_pending:
+            log.info(
+                f'Dropped {n_pending - len(self._pending)} stale execution requests'
+            )
+        superseded = False
+        for msg_id, req in self._in_flight.items():
+            if req.hashid in hashids:
+                continue
+            self._superseded.add(msg_id)
+            superseded = True
+            if not interrupt:
+                continue
+            if msg_id == self._busy:
+                log.info(f'{req.hashid}: Interrupting superseded cell')
+                self.interrupt()
+            else:
+                # queued in the kernel, interrupt once it starts
+                self._interrupts.add(msg_id)
+        return superseded
+
+    def _submit(self) -> None:
+        if self._error and self._pending:
+            self._abort_pending()
+        while (
+            self._ready
+            and self._pending
+            and not (self._retry or self._requeue)
+            and not self._barrier
+            and len(self._in_flight) < self._window
+        ):
+            req = self._pending.popleft()
+            msg_id = self._send_execute(req.hashid, req.code, req.silent)
+            self._in_flight[msg_id] = req
+            if req.barrier:
+                self._barrier = msg_id
+
+    def _abort_pending(self) -> None:
+        log.info(f'Aborting {len(self._pending)} queued execution requests')
+        pending, self._pending = self._pending, deque()
+        if self._aborted:
+            for req in pending:
+                self._aborted(req.hashid)
+
+    def _send_execute(self, hashid: Hash, code: str, silent: bool = False) -> UUID:
+        if self._channels_backend == 'zmq':
+            content = {
+                'code': code,
+                'silent': silent,
+                'store_history': not silent,
+                'user_expressions': {},
+                'allow_stdin': False,
+                'stop_on_error': self.stop_on_error,
+            }
+            msg_id = self._send_shell('execute_request', content)
+        else:
+            msg_id = UUID(
+                self._client.execute(
+                    code,
+                    silent=silent,
+                    store_history=not silent,
+                    stop_on_error=self.stop_on_error,
+                )
+            )
         self._hashids[msg_id] = hashid
+        return msg_id
+
+    def _send_shell(self, msg_type: str, content: Dict[str, Any]) -> UUID:
+        # Session.send writes through a blocking shadow of the socket on newer
+        # jupyter_client, which the asyncio receiver of the socket does not
+        # notice, so the frames go through the asyncio socket itself
+        msg = self._session.msg(msg_type, content)
+        sending = self._shell.send_multipart(self._session.serialize(msg))
+        sending.add_done_callback(self._sent)
+        return UUID(msg['header']['msg_id'])
+
+    def _sent(self, sending: asyncio.Future) -> None:
+        if not sending.cancelled() and sending.exception():
+            log.error(f'Sending to kernel failed: {sending.exception()!r}')
 
     async def _receiver(self) -> None:
         while True:
             dct = await self._msg_queue.get()
+            if dct['msg_type'] in _unhandled_types:
+                continue
             try:
                 msg = jupy.parse(dct)
             except (TypeError, ValueError):
                 log.info(pformat(dct))
                 raise
-            if msg.parent_header:
-                hashid = self._hashids.get(msg.parent_header.msg_id)
-            else:
-                hashid = None
+            self._dispatch(msg)
+
+    def _dispatch(self, msg: jupy.Message) -> None:
+        if not msg.parent_header:
+            self._handler(msg, None)
+            return
+        msg_id = msg.parent_header.msg_id
+        hashid = self._hashids.get(msg_id)
+        if not hashid and self._existing:
+            # other clients of a shared kernel
+            return
+        idle = (
+            isinstance(msg, jupy.STATUS)
+            and msg.content.execution_state == jupy.content.State.IDLE
+        )
+        if idle and msg_id in self._in_flight and msg_id not in self._replied:
+            # iopub can overtake the shell channel, the reply must come first
+            # so that errors and aborts are known when a cell is done
+            self._held[msg_id] = msg
+            return
+        aborted = isinstance(msg, jupy.EXECUTE_REPLY) and isinstance(
+            msg.content, jupy.content.ABORTED
+        )
+        if not (
+            msg_id in self._superseded
+            or msg_id in self._requeue
+            or (aborted and msg_id in self._retry)
+        ):
             self._handler(msg, hashid)
+        if msg_id not in self._in_flight:
+            return
+        if (
+            isinstance(msg, jupy.STATUS)
+            and msg.content.execution_state == jupy.content.State.BUSY
+        ):
+            self._busy = msg_id
+            if msg_id in self._interrupts and msg_id not in self._replied:
+                log.info(f'{hashid}: Interrupting superseded cell')
+                self.interrupt()
+        elif isinstance(msg, jupy.EXECUTE_REPLY):
+            self._replied.add(msg_id)
+            self._process_reply(msg_id, msg)
+            held = self._held.pop(msg_id, None)
+            if held:
+                self._dispatch(held)
+        elif idle:
+            self._finish(msg_id)
+
+    def _process_reply(self, msg_id: UUID, msg: jupy.EXECUTE_REPLY) -> None:
+        # the kernel does not stop on errors of silent requests
+        failed = (
+            isinstance(msg.content, jupy.content.ERROR)
+            and not self._in_flight[msg_id].silent
+        )
+        if msg_id in self._retry:
+            self._retry.discard(msg_id)
+            if isinstance(msg.content, jupy.content.ABORTED):
+                self._requeue[msg_id] = self._in_flight[msg_id]
+        if msg_id in self._superseded:
+            if failed and self.stop_on_error:
+                # the kernel aborts everything queued behind the failure,
+                # wanted requests among those are sent again
+                msg_ids = list(self._in_flight)
+                self._retry.update(
+                    later
+                    for later in msg_ids[msg_ids.index(msg_id) + 1 :]
+                    if later not in self._superseded
+                )
+        elif failed and self.stop_on_error and self._pending:
+            self._abort_pending()
+
+    def _finish(self, msg_id: UUID) -> None:
+        self._replied.discard(msg_id)
+        self._superseded.discard(msg_id)
+        self._interrupts.discard(msg_id)
+        del self._in_flight[msg_id]
+        if self._busy == msg_id:
+            self._busy = None
+        if self._barrier == msg_id:
+            self._barrier = None
+        if (
+            self._requeue
+            and not self._retry
+            and not any(msg_id in self._in_flight for msg_id in self._requeue)
+        ):
+            log.info(f'Resubmitting {len(self._requeue)} aborted execution requests')
+            self._pending.extendleft(reversed(list(self._requeue.values())))
+            self._requeue.clear()
+        self._submit()
+
+    async def _zmq_receiver(self, socket: zmq.asyncio.Socket) -> None:
+        while True:
+            msg_list = await socket.recv_multipart()
+            _, msg_list = self._session.feed_identities(msg_list)
+            dct = self._session.deserialize(msg_list)
+            if not self._handshake(dct):
+                self._msg_queue.put(dct)
+
+    def _handshake(self, dct: Dict[str, Any]) -> bool:
+        msg_type = dct['msg_type']
+        if msg_type == 'kernel_info_reply':
+            return True
+        if msg_type == 'iopub_welcome':
+            # sent by newer kernels once the subscription is in place
+            self._iopub_up.set()
+            return True
+        msg_id = dct['parent_header'].get('msg_id')
+        if msg_id not in self._probes:
+            return False
+        self._iopub_up.set()
+        if dct['content'].get('execution_state') == 'idle':
+            # requests are handled in order, so the earlier probes are done too
+            del self._probes[: self._probes.index(msg_id) + 1]
+        return True
 
     async def _iopub_receiver(self) -> None:
         def partial() -> Dict:
@@ -83,7 +538,7 @@ class Kernel:
                 dct = await self._loop.run_in_executor(None, partial)
             except queue.Empty:
                 continue
-            self._msg_queue.put_nowait(dct)
+            self._msg_queue.put(dct)
 
     async def _shell_receiver(self) -> None:
         def partial() -> Dict:
@@ -94,4 +549,119 @@ class Kernel:
                 dct = await self._loop.run_in_executor(None, partial)
             except queue.Empty:
                 continue
-            self._msg_queue.put_nowait(dct)
+            self._msg_queue.put(dct)
+
+
+class KernelPool:
+    def __init__(
+        self,
+        handler: Callable[[jupy.Message, Optional[Hash]], object],
+        kernel: str = None,
+        channels: str = 'thread',
+        spare: bool = False,
+        existing: Path = None,
+        window: int = 1,
+        aborted: Callable[[Hash], object] = None,
+        failed: Callable[[BaseException], object] = None,
+    ) -> None:
+        self._handler = handler
+        self._default = kernel or 'python3'
+        self._channels_backend = channels
+        self._spare = spare
+        self._existing = existing
+        self._window = window
+        self._aborted: Optional[Callable[[Hash], object]] = aborted
+        self._failed: Optional[Callable[[BaseException], object]] = failed
+        self._stop_on_error = False
+        self._groups: Dict[str, str] = {}
+        self._kernels: Dict[Optional[str], Kernel] = {}
+
+    def set_groups(self, groups: Dict[str, str]) -> None:
+        self._groups = dict(groups)
+
+    def set_stop_on_error(self, stop_on_error: bool) -> None:
+        self._stop_on_error = stop_on_error
+        for kernel in self._kernels.values():
+            kernel.stop_on_error = stop_on_error
+
+    def kernel_name(self, group: str = None) -> str:
+        if group is None:
+            return self._default
+        return self._groups.get(group, self._default)
+
+    def groups(self) -> List[Optional[str]]:
+        return list(self._kernels)
+
+    def start(self) -> None:
+        self._get(None)
+
+    def _get(self, group: Optional[str]) -> Kernel:
+        kernel = self._kernels.get(group)
+        if kernel:
+            return kernel
+        if group is not None:
+            log.info(f'Starting kernel for group {group}')
+        kernel = Kernel(
+            self._handler,
+            self.kernel_name(group),
+            self._channels_backend,
+            self._spare,
+            self._existing if group is None else None,
+            self._window,
+            self._aborted,
+            self._failed,
+        )
+        kernel.stop_on_error = self._stop_on_error
+        kernel.start()
+        self._kernels[group] = kernel
+        return kernel
+
+    def execute(
+        self,
+        hashid: Hash,
+        code: str,
+        group: str = None,
+        priority: bool = False,
+        barrier: bool = False,
+        silent: bool = False,
+    ) -> None:
+        self._get(group).execute(hashid, code, priority, barrier, silent)
+
+    def execute_next(
+        self, hashid: Hash, code: str, group: str = None, silent: bool = False
+    ) -> None:
+        self._get(group).execute_next(hashid, code, silent)
+
+    def supersede(
+        self, hashids: Collection[Hash], interrupt: bool = False
+    ) -> List[Optional[str]]:
+        return [
+            group
+            for group, kernel in self._kernels.items()
+            if kernel.supersede(hashids, interrupt)
+        ]
+
+    def restart(self) -> bool:
+        restarted = [kernel.restart() for kernel in self._kernels.values()]
+        return any(restarted)
+
+    def interrupt(self) -> None:
+        for kernel in self._kernels.values():
+            kernel.interrupt()
+
+    async def cleanup(self) -> None:
+        results = await asyncio.gather(
+            *(kernel.cleanup() for kernel in self._kernels.values()),
+            return_exceptions=True,
+        )
+        self._kernels.clear()
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+
+def channel_url(info: Dict[str, Any], channel: str) -> str:
+    port = info[f'{channel}_port']
+    if info['transport'] == 'tcp':
+        return f'tcp://{info["ip"]}:{port}'
+    return f'{info["transport"]}://{info["ip"]}-{port}'
@@ -6,96 +6,206 @@ import yaml
 
 from .cell import BaseCell, TextCell, CodeCell, JinjaCell
 
-from typing import List, Tuple, Any, Optional, Dict
+from typing import List, Tuple, Any, Optional, Dict, Iterator, NamedTuple, Callable
 
 
 class ParsingError(Exception):
     pass
 
 
+class Span(NamedTuple):
+    start: int
+    cells: List[BaseCell]
+
+
+Tokenizer = Callable[[str, int, int], Iterator[Span]]
+FrontmatterSplitter = Callable[[str], Tuple[Optional[str], int]]
+
+
 class Parser:
     def __init__(self, fmt: str) -> None:
+        self._split_frontmatter: FrontmatterSplitter
+        self._tokenize: Tokenizer
         if fmt == 'markdown':
-            self._parser = parse_markdown
+            self._split_frontmatter = split_markdown_frontmatter
+            self._tokenize = tokenize_markdown
         elif fmt == 'python':
-            self._parser = parse_python
+            self._split_frontmatter = split_python_frontmatter
+            self._tokenize = tokenize_python
         else:
             raise ValueError(f'Unknown format: {fmt}')
+        self._raw_frontmatter: Optional[str] = None
+        self._frontmatter: Optional[Dict[str, Any]] = None
+        self._prev: Optional[Tuple[str, int, int, List[Span]]] = None
 
     def parse(self, text: str) -> Tuple[Optional[Dict[str, Any]], List[BaseCell]]:
-        frontmatter, cells = self._parser(text)
-        if frontmatter is not None:
-            return yaml.load(frontmatter), cells
-        return None, cells
+        frontmatter, start = self._split_frontmatter(text)
+        end = max(start, len(text.rstrip()))
+        spans = self._reparse(text, start, end)
+        self._prev = text, start, end, spans
+        cells = [cell for span in spans for cell in span.cells]
+        if frontmatter is None:
+            return None, cells
+        if frontmatter != self._raw_frontmatter:
+            self._raw_frontmatter = frontmatter
+            self._frontmatter = yaml.load(frontmatter)
+        return self._frontmatter, cells
 
+    def _reparse(self, text: str, start: int, end: int) -> List[Span]:
+        if not self._prev:
+            return list(self._tokenize(text, start, end))
+        old_text, old_start, old_end, old_spans = self._prev
+        prefix = common_prefix(old_text, text)
+        suffix = common_suffix(old_text, text, min(len(old_text), len(text)) - prefix)
+        delta = len(text) - len(old_text)
+        # a span can be reused if the text from its start up to a full line
+        # past the start of the next span is unchanged, which covers the
+        # lookaheads of the tokenizers
+        n_reused = 0
+        if old_start == start:
+            while (
+                n_reused + 1 < len(old_spans)
+                and old_text.find('\n', old_spans[n_reused + 1].start, prefix) >= 0
+            ):
+                n_reused += 1
+        spans = old_spans[:n_reused]
+        pos = spans[-1].start if spans else start
+        if spans:
+            spans.pop()
+        resync = end - delta == old_end
+        idx = len(spans)
+        for span in self._tokenize(text, pos, end):
+            if resync and span.start >= len(text) - suffix:
+                old_pos = span.start - delta
+                while idx < len(old_spans) and old_spans[idx].start < old_pos:
+                    idx += 1
+                if idx < len(old_spans) and old_spans[idx].start == old_pos:
+                    spans.extend(
+                        Span(old.start + delta, old.cells) for old in old_spans[idx:]
+                    )
+                    break
+            spans.append(span)
+        return spans
 
-def parse_markdown(text: str) -> Tuple[Optional[str], List[BaseCell]]:
+
+def common_prefix(a: str, b: str) -> int:
+    n = min(len(a), len(b))
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix(a: str, b: str, limit: int) -> int:
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid : len(a) - lo] == b[len(b) - mid : len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def split_markdown_frontmatter(text: str) -> Tuple[Optional[str], int]:
     m = re.match(r'^---\n((.*\n)*)---\n', text)
     if m:
-        text = text[m.end() :]
-        frontmatter: Optional[str] = m.group(1)
-    else:
-        frontmatter = None
-    text = text.rstrip()
-    cells: List[BaseCell] = []
+        return m.group(1), m.end()
+    return None, 0
+
+
+def split_python_frontmatter(text: str) -> Tuple[Optional[str], int]:
+    m = re.match(r'^# ---\n((# .*\n)*)# ---\n', text)
+    if m:
+        return '\n'.join(l[2:] for l in m.group(1).split('\n')[:-1]), m.end()
+    return None, 0
+
+
+_md_code_start = re.compile(r'```python')
+_md_boundary = re.compile(r'(?<=\n)```python|<!--|$')
+_md_code_end = re.compile(r'(?<=\n)```(?=\s*\n|$)')
+_md_comment_end = re.compile(r'-->')
+
+
+def tokenize_markdown(text: str, pos: int, end: int) -> Iterator[Span]:
+    span = Span(pos, [])
+    yield span
     buffer = ''
-    while text:
-        m = re.search(r'((?<=\n)|^)```python|<!--|$', text)
+    while pos < end:
+        if not buffer and pos != span.start:
+            span = Span(pos, [])
+            yield span
+        m = _md_code_start.match(text, pos, end) or _md_boundary.search(text, pos, end)
         assert m
         if m.group(0) == '```python' or not m.group(0):
-            buffer += text[: m.start()]
+            buffer += text[pos : m.start()]
             buffer = buffer.strip()
             if buffer:
-                cells.append(TextCell(buffer))
+                span.cells.append(TextCell(buffer))
                 buffer = ''
-            text = text[m.end() :]
+            pos = m.end()
         if m.group(0) == '```python':
-            m = re.search(r'(?<=\n)```(?=\s*\n|$)', text)
+            m = _md_code_end.search(text, pos, end)
             if not m:
                 raise ParsingError('Unclosed Python cell')
-            code = text[: m.start()].strip()
-            cells.append(CodeCell(code))
-            text = text[m.end() :]
+            code = text[pos : m.start()].strip()
+            span.cells.append(CodeCell(code))
+            pos = m.end()
         elif m.group(0) == '<!--':
-            m = re.search(r'-->', text)
+            m = _md_comment_end.search(text, pos, end)
             if not m:
                 raise ParsingError('Unclosed HTML comment')
-            buffer += text[: m.end()]
-            text = text[m.end() :]
-    return frontmatter, cells
+            buffer += text[pos : m.end()]
+            pos = m.end()
 
 
-def parse_python(text: str) -> Tuple[Optional[str], List[BaseCell]]:
-    m = re.match(r'^# ---\n((# .*\n)*)# ---\n', text)
-    if m:
-        text = text[m.end() :]
-        frontmatter: Optional[str] = '\n'.join(
-            l[2:] for l in m.group(1).split('\n')[:-1]
-        )
-    else:
-        frontmatter = None
-    text = text.rstrip()
-    cells: List[BaseCell] = []
-    buffer = ''
-    while text:
-        m = re.search(r'((?<=\n)|^)# ?::>|$', text)
+_py_text_start = re.compile(r'# ?::>')
+_py_boundary = re.compile(r'(?<=\n)# ?::>|$')
+_py_text_end = re.compile(r'(?<=\n)[^#]|$')
+
+
+def tokenize_python(text: str, pos: int, end: int) -> Iterator[Span]:
+    span = Span(pos, [])
+    yield span
+    while pos < end:
+        if pos != span.start:
+            span = Span(pos, [])
+            yield span
+        m = _py_text_start.match(text, pos, end) or _py_boundary.search(text, pos, end)
         assert m
-        buffer += text[: m.start()]
-        buffer = buffer.strip()
+        buffer = text[pos : m.start()].strip()
         if buffer:
             buffer = re.sub(r'((?<=\n)|^)#\s*::%', '%', buffer)
-            cells.append(CodeCell(buffer))
-            buffer = ''
-        text = text[m.end() :]
+            span.cells.append(CodeCell(buffer))
+        pos = m.end()
         if m.group(0):
-            m = re.search(r'(?<=\n)[^#]|$', text)
+            m = _py_text_end.search(text, pos, end)
             if not m:
                 raise ParsingError('Unclosed Markdown cell')
-            chunk, text = text[: m.start()], text[m.start() :]
+            chunk, pos = text[pos : m.start()], m.start()
             assert chunk[0] in {'\n', 'j'}
             is_jinja = chunk[0] == 'j'
             if is_jinja:
                 chunk = chunk[1:]
             md = re.sub(r'((?<=\n)|^)# ?', '', chunk.strip())
-            cells.append(JinjaCell(md) if is_jinja else TextCell(md))
-    return frontmatter, cells
+            span.cells.append(JinjaCell(md) if is_jinja else TextCell(md))
+
+
+def parse_markdown(text: str) -> Tuple[Optional[str], List[BaseCell]]:
+    frontmatter, start = split_markdown_frontmatter(text)
+    end = max(start, len(text.rstrip()))
+    # spans are yielded before they are filled
+    spans = list(tokenize_markdown(text, start, end))
+    return frontmatter, [cell for span in spans for cell in span.cells]
+
+
+def parse_python(text: str) -> Tuple[Optional[str], List[BaseCell]]:
+    frontmatter, start = split_python_frontmatter(text)
+    end = max(start, len(text.rstrip()))
+    # spans are yielded before they are filled
+    spans = list(tokenize_python(text, start, end))
+    return frontmatter, [cell for span in spans for cell in span.cells]
@@ -0,0 +1,102 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import sys
+import time
+import signal
+import multiprocessing
+import asyncio
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import ansi2html
+from misaka import Markdown, HtmlRenderer
+import pygments
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import PythonLexer
+
+from typing import Callable, Iterable, NamedTuple, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .cell import BaseCell  # noqa: F401
+
+log = logging.getLogger('knitj.render')
+
+_md_extensions = 'fenced-code math math-explicit tables quote'.split()
+_md = Markdown(HtmlRenderer(), extensions=_md_extensions)
+_lexer = PythonLexer()
+_formatter = HtmlFormatter()
+_ansi_convert = ansi2html.Ansi2HTMLConverter().convert
+
+# bump the revision whenever the cached HTML fragments change
+RENDER_FINGERPRINT = f'1:pygments={pygments.__version__}:md={",".join(_md_extensions)}'
+
+
+def markdown(text: str) -> str:
+    return _md(text)
+
+
+def highlight(code: str) -> str:
+    return pygments.highlight(code, _lexer, _formatter)
+
+
+def ansi_to_html(text: str) -> str:
+    return _ansi_convert(text, full=False)
+
+
+class RenderJob(NamedTuple):
+    func: Callable[[str], str]
+    arg: str
+    done: Callable[[str], None]
+
+
+class Renderer:
+    def __init__(self, workers: int = None) -> None:
+        self._workers = workers
+        self._executor: Optional[Executor] = None
+        self._n_jobs = 0
+
+    async def prerender(self, cells: Iterable['BaseCell']) -> None:
+        jobs = [job for cell in cells for job in cell.render_jobs()]
+        if not jobs:
+            return
+        if self._executor is None:
+            self._executor = self._new_executor()
+        start = time.time()
+        results = await asyncio.gather(*(self._submit(job) for job in jobs))
+        for job, result in zip(jobs, results):
+            job.done(result)
+        self._n_jobs += len(jobs)
+        if len(jobs) > 1:
+            log.info(f'Rendered {len(jobs)} fragments in {time.time() - start:.2f}s')
+
+    def _new_executor(self) -> Executor:
+        if not self._workers:
+            # Pygments and ansi2html are pure Python and hold the GIL, so more
+            # threads would not render faster, only worker processes do
+            return ThreadPoolExecutor(1)
+        # kernel channels and the file watcher run in threads by now, forking
+        # the workers from a threaded process can deadlock them
+        if sys.version_info >= (3, 7):
+            context = multiprocessing.get_context('spawn')
+            return ProcessPoolExecutor(self._workers, mp_context=context)
+        return ProcessPoolExecutor(self._workers)
+
+    def _submit(self, job: RenderJob) -> 'asyncio.Future[str]':
+        loop = asyncio.get_event_loop()
+        if not self._workers:
+            return loop.run_in_executor(self._executor, job.func, job.arg)
+        # worker processes are started on submit and inherit the ignored
+        # SIGINT, Ctrl-C is handled by the main process
+        handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            return loop.run_in_executor(self._executor, job.func, job.arg)
+        finally:
+            signal.signal(signal.SIGINT, handler)
+
+    def shutdown(self) -> None:
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+        where = f'{self._workers} worker processes' if self._workers else 'a thread'
+        log.info(f'{self._n_jobs} fragments rendered in {where}')
@@ -6,42 +6,180 @@ from pathlib import Path
 import asyncio
 import webbrowser
 import json
+import html
 import logging
+from functools import partial
 
 from aiohttp import web
 
-from .kernel import Kernel
+from .kernel import KernelPool
 from .source import SourceWatcher
 from .webserver import init_webapp
 from .parser import Parser
-from .document import Document
+from .document import Document, Edit
 from .cell import Hash, CodeCell
-from .convert import render_index
+from .convert import render_index, cache_keys
+from .blob import BlobStore
+from .spill import SpillStore
+from .checkpoint import CheckpointStore, CheckpointJobs, checkpoint_due
+from .render import Renderer
 from . import jupyter_messaging as jupy
 
-from typing import Set, Dict, List, Optional
+from typing import Any, Set, Dict, List, Optional, Callable, Tuple
 
 log = logging.getLogger('knitj.knitj')
 
 
+def merge_stream_appends(first: Dict, second: Dict) -> Optional[Dict]:
+    if first['seq'] != second['base']:
+        return None
+    text = first['text']
+    if second['rewrite']:
+        idx = text.rfind('\n')
+        if idx < 0:
+            return {**second, 'base': first['base']}
+        text = text[: idx + 1]
+    return {**first, 'text': text + second['text'], 'seq': second['seq']}
+
+
 class Broadcaster:
-    def __init__(self, wss: Set[web.WebSocketResponse]) -> None:
+    def __init__(self, wss: Set[web.WebSocketResponse], max_rate: float = 30) -> None:
         self._wss = wss
-        self._queue: 'asyncio.Queue[Dict]' = asyncio.Queue()
+        self._interval = 1 / max_rate
+        self._pending: List[Dict] = []
+        self._has_pending = asyncio.Event()
+        self._n_registered = 0
+        self._n_sent = 0
+
+    @property
+    def n_merged(self) -> int:
+        return self._n_registered - self._n_sent - len(self._pending)
 
     def register_message(self, msg: Dict) -> None:
-        self._queue.put_nowait(msg)
+        self._n_registered += 1
+        if msg['kind'] in {'cell', 'stream_append'}:
+            self._merge_cell(msg)
+        elif msg['kind'] == 'patch':
+            self._merge_patch(msg)
+        else:
+            self._pending.append(msg)
+        self._has_pending.set()
+
+    def _merge_cell(self, msg: Dict) -> None:
+        pending = self._pending
+        for idx in reversed(range(len(pending))):
+            prev = pending[idx]
+            if prev['kind'] == 'patch':
+                break
+            if prev.get('hashid') != msg['hashid']:
+                continue
+            if msg['kind'] == 'cell':
+                del pending[idx]
+                continue
+            if prev['kind'] == 'stream_append':
+                merged = merge_stream_appends(prev, msg)
+                if merged:
+                    pending[idx] = merged
+                    return
+            break
+        pending.append(msg)
+
+    def _merge_patch(self, msg: Dict) -> None:
+        superseded = {op['hashid'] for op in msg['ops'] if op['op'] != 'move'}
+        pending = [
+            m
+            for m in self._pending
+            if m['kind'] not in {'cell', 'stream_append'}
+            or m['hashid'] not in superseded
+        ]
+        if pending and pending[-1]['kind'] == 'patch':
+            pending[-1] = {'kind': 'patch', 'ops': pending[-1]['ops'] + msg['ops']}
+        else:
+            pending.append(msg)
+        self._pending = pending
 
     async def run(self) -> None:
         log.info(f'Started broadcasting to browsers')
         while True:
-            msg = await self._queue.get()
-            data = json.dumps(msg)
-            for ws in list(self._wss):
-                try:
-                    await ws.send_str(data)
-                except ConnectionResetError:
-                    self._wss.remove(ws)
+            await self._has_pending.wait()
+            self._has_pending.clear()
+            msgs, self._pending = self._pending, []
+            for msg in msgs:
+                await self._send(json.dumps(msg))
+            self._n_sent += len(msgs)
+            await asyncio.sleep(self._interval)
+
+    async def _send(self, data: str) -> None:
+        wss = list(self._wss)
+        results = await asyncio.gather(
+            *(ws.send_str(data) for ws in wss), return_exceptions=True
+        )
+        for ws, result in zip(wss, results):
+            if isinstance(result, ConnectionResetError):
+                self._wss.discard(ws)
+            elif isinstance(result, Exception):
+                raise result
+
+
+def write_atomic(path: Path, text: str) -> None:
+    tmp = path.with_name(f'.{path.name}.tmp')
+    tmp.write_text(text)
+    os.replace(tmp, path)
+
+
+def write_files(files: List[Tuple[Path, str]]) -> None:
+    for path, text in files:
+        write_atomic(path, text)
+
+
+def state_path(output: Path) -> Path:
+    return output.with_suffix('.knitj')
+
+
+class OutputWriter:
+    def __init__(
+        self, targets: List[Tuple[Path, Callable[[], str]]], delay: float
+    ) -> None:
+        self._targets = targets
+        self._delay = delay
+        self._pending = asyncio.Event()
+        self._writing: Optional[asyncio.Future] = None
+        self._n_updates = 0
+        self._n_writes = 0
+
+    def register_update(self) -> None:
+        self._n_updates += 1
+        self._pending.set()
+
+    async def run(self) -> None:
+        while True:
+            await self._pending.wait()
+            await asyncio.sleep(self._delay)
+            await self.flush()
+
+    async def flush(self) -> None:
+        while self._writing:
+            await asyncio.wait({self._writing})
+        if not self._pending.is_set():
+            return
+        self._pending.clear()
+        loop = asyncio.get_event_loop()
+        files = [(path, render()) for path, render in self._targets]
+        writing = loop.run_in_executor(None, write_files, files)
+        writing.add_done_callback(self._write_done)
+        self._writing = writing
+        await asyncio.wait({writing})
+        writing.result()
+
+    def _write_done(self, writing: asyncio.Future) -> None:
+        self._writing = None
+        self._n_writes += 1
+
+    def log_stats(self) -> None:
+        log.info(
+            f'Output written {self._n_writes} times for {self._n_updates} updates '
+            f'({self._n_updates - self._n_writes} coalesced)'
+        )
 
 
 class KnitjServer:
@@ -52,25 +190,77 @@ class KnitjServer:
         fmt: str,
         browser: webbrowser.BaseBrowser = None,
         kernel: str = None,
+        write_delay: float = 0.5,
+        max_rate: float = 30,
+        channels: str = 'thread',
+        interrupt_stale: bool = False,
+        debounce: float = 0.05,
+        blobs: BlobStore = None,
+        spills: SpillStore = None,
+        spare_kernel: bool = False,
+        existing: Path = None,
+        checkpoints: CheckpointStore = None,
+        rerun_dependents: bool = False,
+        window: int = 1,
+        renderer: Renderer = None,
     ) -> None:
         source, output = Path(source), Path(output)
         self._browser = browser
-        self._kernel = Kernel(self._kernel_handler, kernel)
-        app = init_webapp(self.get_index, self._ws_msg_handler)
+        self._interrupt_stale = interrupt_stale
+        self._rerun_dependents = rerun_dependents
+        self._renderer = renderer
+        self._existing = existing
+        # cells before and after a checkpoint being restored
+        self._restores: Dict[Hash, Tuple[List[CodeCell], List[CodeCell]]] = {}
+        # cells run in order in each kernel since it started, None once its
+        # namespace no longer follows from such a chain
+        self._executed: Dict[Optional[str], Optional[List[Hash]]] = {}
+        self._rendering: Dict[Hash, asyncio.Future] = {}
+        self._kernel = KernelPool(
+            self._kernel_handler,
+            kernel,
+            channels,
+            spare_kernel,
+            existing,
+            window,
+            self._abort_handler,
+            self._kernel_failed,
+        )
+        self._checkpoint_jobs = (
+            CheckpointJobs(self._kernel, checkpoints) if checkpoints else None
+        )
+        self._stopped = asyncio.get_event_loop().create_future()
+        self._kernel.start()
+        app = init_webapp(self.get_index, self._ws_msg_handler, blobs, spills)
         self._webrunner = web.AppRunner(app)
-        self._broadcaster = Broadcaster(app['wss'])
-        self._watcher = SourceWatcher(self._source_handler, source)
+        self._broadcaster = Broadcaster(app['wss'], max_rate)
+        self._watcher = SourceWatcher(self._source_handler, source, debounce)
         self._document = Document(Parser(fmt))
-        if source.exists():
-            self._document.update_from_source(source.read_text())
+        text = self._watcher.read()
+        if text is not None:
+            self._document.update_from_source(text)
+            self._configure_kernel()
+        state = state_path(output)
         if output.exists():
-            self._document.load_output_from_html(output.read_text())
-        self._output = output
+            if state.exists() and state.stat().st_mtime >= output.stat().st_mtime:
+                with state.open() as f:
+                    self._document.load_state(f)
+            else:
+                self._document.load_output_from_html(output.read_text())
+        self._restore_checkpoints()
+        self._writer = OutputWriter(
+            [
+                (output, lambda: self.get_index(client=False)),
+                (state, lambda: ''.join(self._document.dump_state())),
+            ],
+            write_delay,
+        )
         self._tasks: List[asyncio.Future] = []
 
     async def start(self) -> None:
+        if self._renderer:
+            await self._renderer.prerender(self._document)
         await self._webrunner.setup()
-        self._kernel.start()
         for port in range(8080, 8100):
             try:
                 site = web.TCPSite(self._webrunner, 'localhost', port)
@@ -89,21 +279,35 @@ class KnitjServer:
             [
                 loop.create_task(self._broadcaster.run()),
                 loop.create_task(self._watcher.run()),
+                loop.create_task(self._writer.run()),
             ]
         )
 
+    async def run(self) -> None:
+        await self._stopped
+
     async def cleanup(self) -> None:
-        await asyncio.gather(self._webrunner.cleanup(), self._kernel.cleanup())
+        if not self._stopped.done():
+            self._stopped.set_result(None)
+        results = await asyncio.gather(
+            self._webrunner.cleanup(), self._kernel.cleanup(), return_exceptions=True
+        )
         for task in self._tasks:
             task.cancel()
             try:
                 await task
             except asyncio.CancelledError:
                 pass
+        await self._writer.flush()
+        self._writer.log_stats()
+        log.info(f'{self._broadcaster.n_merged} browser messages merged')
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
 
     def update_all(self, msg: Dict) -> None:
         self._broadcaster.register_message(msg)
-        self._output.write_text(self.get_index(client=False))
+        self._writer.register_update()
 
     def get_index(self, client: bool = True) -> str:
         cells = '\n'.join(cell.html for cell in self._document)
@@ -114,6 +318,10 @@ class KnitjServer:
         return render_index('', cells, client=client, template=template)
 
     def _kernel_handler(self, msg: jupy.Message, hashid: Optional[Hash]) -> None:
+        if self._checkpoint_jobs and hashid in self._checkpoint_jobs:
+            assert hashid
+            self._checkpoint_jobs.process_message(msg, hashid)
+            return
         if not hashid:
             if isinstance(msg, jupy.STATUS):
                 if msg.content.execution_state == jupy.content.State.STARTING:
@@ -127,41 +335,232 @@ class KnitjServer:
         cell = self._document.process_message(msg, hashid)
         if not cell:
             return
+        if self._checkpoint_jobs:
+            self._track_checkpoint(msg, cell)
+        delta = cell.pop_stream_delta() if isinstance(msg, jupy.STREAM) else None
+        if delta:
+            text, rewrite, base = delta
+            self.update_all(
+                {
+                    'kind': 'stream_append',
+                    'hashid': cell.hashid.value,
+                    'text': html.escape(text),
+                    'rewrite': rewrite,
+                    'base': base,
+                    'seq': cell.stream_seq,
+                }
+            )
+        elif self._renderer and cell.render_jobs():
+            self._render_cell(cell)
+        else:
+            self.update_all(
+                {'kind': 'cell', 'hashid': cell.hashid.value, 'html': cell.html}
+            )
+
+    def _render_cell(self, cell: CodeCell) -> None:
+        # the cell is sent once the pending render is done
+        if cell.hashid not in self._rendering:
+            self._rendering[cell.hashid] = asyncio.ensure_future(
+                self._render_until_done(cell)
+            )
+
+    async def _render_until_done(self, cell: CodeCell) -> None:
+        assert self._renderer
+        try:
+            # messages received meanwhile can leave more to render
+            while cell.render_jobs():
+                await self._renderer.prerender([cell])
+        finally:
+            del self._rendering[cell.hashid]
         self.update_all(
             {'kind': 'cell', 'hashid': cell.hashid.value, 'html': cell.html}
         )
 
+    def _abort_handler(self, hashid: Hash) -> None:
+        if self._checkpoint_jobs and hashid in self._checkpoint_jobs:
+            self._checkpoint_jobs.abort(hashid)
+            return
+        cell = self._document.abort(hashid)
+        if cell:
+            self.update_all(
+                {'kind': 'cell', 'hashid': cell.hashid.value, 'html': cell.html}
+            )
+
+    def _kernel_failed(self, exc: BaseException) -> None:
+        if not self._stopped.done():
+            self._stopped.set_result(None)
+
+    def _track_checkpoint(self, msg: jupy.Message, cell: CodeCell) -> None:
+        assert self._checkpoint_jobs
+        if (
+            not isinstance(msg, jupy.STATUS)
+            or msg.content.execution_state != jupy.content.State.IDLE
+            or cell.aborted
+        ):
+            return
+        executed = self._executed_in(cell.kernel)
+        if executed is None:
+            return
+        executed.append(cell.hashid)
+        if not checkpoint_due(msg, cell):
+            return
+        # the key stands for the cells above run in order, which the
+        # namespace reflects only if exactly those have run
+        cells = [c for c in self._code_cells() if c.kernel == cell.kernel]
+        if executed != [c.hashid for c in cells[: cells.index(cell) + 1]]:
+            log.info(f'{cell.hashid}: Cells above ran out of order, no checkpoint')
+            return
+        key = cache_keys(self._code_cells(), self._kernel)[cell.hashid]
+        self._checkpoint_jobs.save(cell, key)
+
+    def _executed_in(self, group: Optional[str]) -> Optional[List[Hash]]:
+        if group not in self._executed:
+            # an attached kernel has a namespace of unknown origin
+            self._executed[group] = None if self._existing and group is None else []
+        return self._executed[group]
+
+    def _resume_after_restore(
+        self, key: Hash, restored: 'asyncio.Future[bool]'
+    ) -> None:
+        # a restore cancelled by a kernel restart has been replaced
+        if restored.cancelled():
+            return
+        before, after = self._restores.pop(key)
+        group = before[-1].kernel
+        if restored.result():
+            self._executed[group] = [cell.hashid for cell in before]
+        else:
+            log.warning(f'Checkpoint {key}: Executing from the first cell instead')
+            for cell in before:
+                cell.reset()
+                self.update_all(
+                    {'kind': 'cell', 'hashid': cell.hashid.value, 'html': cell.html}
+                )
+            after = before + after
+        # skip cells that were edited away while restoring
+        current = set(self._document.hashes())
+        for cell in after:
+            if cell.hashid in current and self._document[cell.hashid] is cell:
+                self._execute(cell)
+
+    def _code_cells(self) -> List[CodeCell]:
+        return [cell for cell in self._document if isinstance(cell, CodeCell)]
+
+    def _execute(self, cell: CodeCell, priority: bool = False) -> None:
+        # a checkpoint must not see effects of cells sent ahead
+        barrier = bool(self._checkpoint_jobs) and 'checkpoint' in cell.flags
+        self._kernel.execute(cell.hashid, cell.code, cell.kernel, priority, barrier)
+
+    def _restore_checkpoints(self) -> None:
+        if not self._checkpoint_jobs:
+            return
+        cells = self._code_cells()
+        key_of = cache_keys(cells, self._kernel)
+        groups: Dict[Optional[str], List[CodeCell]] = {}
+        for cell in cells:
+            groups.setdefault(cell.kernel, []).append(cell)
+        for group, group_cells in groups.items():
+            if group is None and self._existing:
+                # an attached kernel keeps its namespace
+                continue
+            for idx in reversed(range(len(group_cells))):
+                if 'checkpoint' in group_cells[idx].flags:
+                    key = key_of[group_cells[idx].hashid]
+                    path = self._checkpoint_jobs.get_path(key)
+                    if path:
+                        break
+            else:
+                continue
+            # the remaining cells are sent once the restore is done
+            self._restores[key] = group_cells[: idx + 1], group_cells[idx + 1 :]
+            self._executed[group] = None
+            restored = self._checkpoint_jobs.restore(key, path, group)
+            restored.add_done_callback(partial(self._resume_after_restore, key))
+            for cell in group_cells[idx + 1 :]:
+                cell.reset()
+
     def _ws_msg_handler(self, msg: Dict) -> None:
         if msg['kind'] == 'reevaluate':
             hashids = [Hash(hashid) for hashid in msg['hashids']]
+            if self._rerun_dependents:
+                selected = {*hashids, *self._document.dependents(hashids)}
+                hashids = [
+                    hashid for hashid in self._document.hashes() if hashid in selected
+                ]
             log.info(f'Will reevaluate cells: {", ".join(map(str, hashids))}')
             for hashid in hashids:
                 cell = self._document[hashid]
                 assert isinstance(cell, CodeCell)
                 cell.reset()
-                self._kernel.execute(hashid, cell.code)
+                self._execute(cell, priority=True)
         elif msg['kind'] == 'restart_kernel':
-            self._kernel.restart()
+            if self._kernel.restart():
+                self._broadcaster.register_message({'kind': 'kernel_starting'})
+                if self._checkpoint_jobs:
+                    self._checkpoint_jobs.clear()
+                self._restores.clear()
+                self._executed.clear()
+                self._restore_checkpoints()
+        elif msg['kind'] == 'get_cell':
+            # sent by a browser whose stream is out of step with the deltas
+            hashid = Hash(msg['hashid'])
+            if hashid in self._document.hashes():
+                cell = self._document[hashid]
+                self._broadcaster.register_message(
+                    {'kind': 'cell', 'hashid': hashid.value, 'html': cell.html}
+                )
         elif msg['kind'] == 'interrupt_kernel':
             self._kernel.interrupt()
+            # an interrupted cell leaves its effects incomplete
+            for group in self._kernel.groups():
+                self._executed[group] = None
         elif msg['kind'] == 'ping':
             pass
         else:
             raise ValueError(f'Unkonwn message: {msg["kind"]}')
 
-    def _source_handler(self, src: str) -> None:
+    def _configure_kernel(self) -> None:
+        frontmatter = self._document.frontmatter
+        self._kernel.set_groups(frontmatter.get('kernels', {}))
+        self._kernel.set_stop_on_error(bool(frontmatter.get('stop_on_error', False)))
+
+    async def _source_handler(self, src: str) -> None:
         doc = self._document
-        new_cells, updated_cells = doc.update_from_source(src)
-        for cell in new_cells:
-            if isinstance(cell, CodeCell):
-                cell._flags.add('evaluating')
-        self.update_all(
-            {
-                'kind': 'document',
-                'hashids': [hashid.value for hashid in doc.hashes()],
-                'htmls': {cell.hashid.value: cell.html for cell in updated_cells},
-            }
+        previous = list(doc.items())
+        new_cells, edits = doc.update_from_source(src)
+        self._configure_kernel()
+        new_code = {cell.hashid for cell in new_cells if isinstance(cell, CodeCell)}
+        stale = doc.dependents(new_code, previous) if self._rerun_dependents else []
+        if stale:
+            log.info(f'Will rerun dependent cells: {", ".join(map(str, stale))}')
+        superseded = self._kernel.supersede(
+            set(doc.hashes()) - set(stale) | set(self._checkpoint_jobs or ()),
+            self._interrupt_stale,
         )
-        for cell in new_cells:
-            if isinstance(cell, CodeCell):
-                self._kernel.execute(cell.hashid, cell.code)
+        for group in superseded:
+            self._executed[group] = None
+        for hashid in stale:
+            cell = doc[hashid]
+            assert isinstance(cell, CodeCell)
+            cell.reset()
+            edits.append(Edit('update', hashid))
+        to_run = [
+            cell
+            for hashid, cell in doc.items()
+            if isinstance(cell, CodeCell) and (hashid in new_code or hashid in stale)
+        ]
+        for cell in to_run:
+            cell._flags.add('evaluating')
+        if self._renderer:
+            await self._renderer.prerender(new_cells)
+        ops: List[Dict] = []
+        for edit in edits:
+            op: Dict[str, Any] = {'op': edit.kind, 'hashid': edit.hashid.value}
+            if edit.kind in {'insert', 'move'}:
+                op['after'] = edit.after.value if edit.after else None
+            if edit.kind in {'insert', 'update'}:
+                op['html'] = doc[edit.hashid].html
+            ops.append(op)
+        self.update_all({'kind': 'patch', 'ops': ops})
+        for cell in to_run:
+            self._execute(cell)
@@ -8,47 +8,99 @@ import asyncio
 from asyncio import Queue
 
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler, FileSystemEvent
+from watchdog.events import (
+    FileSystemEventHandler,
+    FileSystemEvent,
+    FileSystemMovedEvent,
+)
 
-from .cell import Hash  # noqa
+from .cell import Hash
 
-from typing import Callable
+from typing import Awaitable, Callable, Optional, Tuple
 
 log = logging.getLogger('knitj.source')
 
 
 class FileChangedHandler(FileSystemEventHandler):
-    def __init__(self, queue: 'Queue[str]') -> None:
+    def __init__(self, queue: 'Queue[str]', path: Path) -> None:
         super().__init__()
         self._loop = asyncio.get_event_loop()
         self._queue = queue
+        self._path = path
 
-    def _queue_modified(self, event: FileSystemEvent) -> None:
+    def _queue_modified(self, path: str) -> None:
+        if Path(path) != self._path:
+            return
         # Must be done this way because watchdog doesn't support asyncio
         # and the on_modified, on_created functions are run in different thread
-        self._loop.call_soon_threadsafe(self._queue.put_nowait, event.src_path)
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, path)
 
     def on_modified(self, event: FileSystemEvent) -> None:
-        self._queue_modified(event)
+        self._queue_modified(event.src_path)
 
     def on_created(self, event: FileSystemEvent) -> None:
-        self._queue_modified(event)
+        self._queue_modified(event.src_path)
+
+    def on_moved(self, event: FileSystemMovedEvent) -> None:
+        self._queue_modified(event.dest_path)
 
 
 class SourceWatcher:
-    def __init__(self, handler: Callable[[str], None], path: os.PathLike) -> None:
+    def __init__(
+        self,
+        handler: Callable[[str], Awaitable[None]],
+        path: os.PathLike,
+        debounce: float = 0.05,
+    ) -> None:
         self._path = Path(path)
         self._handler = handler
+        self._debounce = debounce
+        self._stat: Optional[Tuple[int, int]] = None
+        self._hashid: Optional[Hash] = None
         self._file_change: 'Queue[str]' = Queue()
         self._observer = Observer()
         self._observer.schedule(
-            FileChangedHandler(queue=self._file_change), str(self._path.parent)
+            FileChangedHandler(queue=self._file_change, path=self._path),
+            str(self._path.parent),
         )
 
+    def read(self) -> Optional[str]:
+        # the returned text is the baseline against which changes are detected
+        return self._read_if_changed()
+
     async def run(self) -> None:
         self._observer.start()
         log.info(f'Started watching file {self._path} for changes')
+        # catch changes saved since the baseline was read
+        text = self._read_if_changed()
+        if text is not None:
+            await self._handler(text)
         while True:
-            file = Path(await self._file_change.get())
-            if file == self._path:
-                self._handler(file.read_text())
+            await self._file_change.get()
+            await self._settle()
+            text = self._read_if_changed()
+            if text is not None:
+                await self._handler(text)
+
+    async def _settle(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._file_change.get(), self._debounce)
+            except asyncio.TimeoutError:
+                return
+
+    def _read_if_changed(self) -> Optional[str]:
+        try:
+            stat = self._path.stat()
+        except FileNotFoundError:
+            return None
+        if (stat.st_mtime_ns, stat.st_size) == self._stat:
+            return None
+        self._stat = stat.st_mtime_ns, stat.st_size
+        text = self._path.read_text()
+        hashid = Hash.from_string(text)
+        if hashid == self._hashid:
+            log.info('File saved without changes')
+            return None
+        self._hashid = hashid
+        return text
@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import re
+import uuid
+import hashlib
+import logging
+from pathlib import Path
+
+from .blob import collect_unreferenced
+
+from typing import IO, Iterable, Optional
+
+log = logging.getLogger('knitj.spill')
+
+SPILL_NAME = re.compile(r'[0-9a-f]{32,64}\.(txt|html)')
+
+
+class SpillLog:
+    def __init__(self, path: Path, url: str) -> None:
+        self._path = path
+        self._url = url
+        self._file: Optional[IO[str]] = None
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+    def write(self, s: str) -> None:
+        if self._file is None:
+            self._file = self._path.open('a')
+        self._file.write(s)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SpillStore:
+    def __init__(
+        self, path: Path, threshold: int = 1 << 20, preview: int = 1 << 13
+    ) -> None:
+        self._path = path
+        self._threshold = threshold
+        self._preview = preview
+
+    @property
+    def threshold(self) -> int:
+        return self._threshold
+
+    @property
+    def preview(self) -> int:
+        return self._preview
+
+    def put(self, text: str, ext: str) -> str:
+        data = text.encode()
+        name = f'{hashlib.sha256(data).hexdigest()}.{ext}'
+        path = self._path / name
+        if not path.exists():
+            self._path.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f'.{name}.tmp')
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+            log.info(f'Spilled output {name[:6]} ({len(data)} bytes)')
+        return f'spill/{name}'
+
+    def open_log(self) -> SpillLog:
+        self._path.mkdir(parents=True, exist_ok=True)
+        name = f'{uuid.uuid4().hex}.txt'
+        return SpillLog(self._path / name, f'spill/{name}')
+
+    def collect(self, documents: Iterable[Path], before: float) -> None:
+        collect_unreferenced(self._path, SPILL_NAME, documents, before)
+
+    def get_path(self, name: str) -> Optional[Path]:
+        if not SPILL_NAME.fullmatch(name):
+            return None
+        path = self._path / name
+        return path if path.exists() else None
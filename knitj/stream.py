@@ -0,0 +1,94 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from collections import deque
+
+from typing import Callable, Deque, List, Optional, Tuple
+
+
+class StreamBuffer:
+    def __init__(
+        self,
+        max_lines: int = 1000,
+        max_chars: int = 1 << 20,
+        max_line: int = 10_000,
+        on_elide: Callable[[str], None] = None,
+    ) -> None:
+        self._n_head = max_lines // 2
+        self._n_tail = max_lines - self._n_head
+        self._max_chars = max_chars
+        self._max_line = max_line
+        self._on_elide: Optional[Callable[[str], None]] = on_elide
+        self._head: List[str] = []
+        self._tail: Deque[str] = deque()
+        self._last = ''
+        self._size = 0
+        self._n_elided = 0
+        self._text: Optional[str] = ''
+
+    def __bool__(self) -> bool:
+        return bool(self._head or self._tail or self._last or self._n_elided)
+
+    def __str__(self) -> str:
+        if self._text is None:
+            head, n_elided, tail = self.parts()
+            marker = f'{elision_marker(n_elided)}\n' if n_elided else ''
+            self._text = head + marker + tail
+        return self._text
+
+    def parts(self) -> Tuple[str, int, str]:
+        head = ''.join(f'{line}\n' for line in self._head)
+        tail = '\n'.join([*self._tail, self._last])
+        return head, self._n_elided, tail
+
+    def clear(self) -> None:
+        self._head.clear()
+        self._tail.clear()
+        self._last = ''
+        self._size = 0
+        self._n_elided = 0
+        self._text = ''
+
+    def write(self, s: str, rewrite: bool = False) -> bool:
+        if rewrite:
+            self._last = ''
+        first, *lines = s.split('\n')
+        self._last += first
+        exact = True
+        for line in lines:
+            exact = self._push(self._last[: self._max_line]) and exact
+            self._last = line
+        if len(self._last) > self._max_line:
+            self._last = self._last[: self._max_line]
+            exact = False
+        self._text = None
+        return exact
+
+    def _push(self, line: str) -> bool:
+        self._size += len(line)
+        if len(self._head) < self._n_head and self._size <= self._max_chars:
+            self._head.append(line)
+            return True
+        self._tail.append(line)
+        exact = True
+        while self._tail and (
+            len(self._tail) > self._n_tail or self._size > self._max_chars
+        ):
+            line = self._tail.popleft()
+            self._size -= len(line)
+            self._n_elided += 1
+            if self._on_elide:
+                self._on_elide(line)
+            exact = False
+        return exact
+
+
+def elision_marker(n_elided: int) -> str:
+    return f'[... {n_elided} lines elided ...]'
+
+
+def merge_stream_text(first: str, second: str) -> str:
+    if not second.startswith('\r'):
+        return first + second
+    idx = first.rfind('\n')
+    return second if idx < 0 else first[: idx + 1] + second[1:]
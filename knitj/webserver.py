@@ -7,6 +7,9 @@ from pkg_resources import resource_filename
 
 from aiohttp import web, WSCloseCode
 
+from .blob import BlobStore
+from .spill import SpillStore
+
 from typing import Callable, Dict
 
 log = logging.getLogger('knitj.webserver')
@@ -36,17 +39,44 @@ async def handler(request: web.Request) -> web.Response:
     raise web.HTTPNotFound()
 
 
+async def blob_handler(request: web.Request) -> web.Response:
+    blobs: BlobStore = request.app['blobs']
+    path = blobs.get_path(request.match_info['name'])
+    if not path:
+        raise web.HTTPNotFound()
+    return web.FileResponse(
+        path, headers={'Cache-Control': 'public, max-age=31536000, immutable'}
+    )
+
+
+async def spill_handler(request: web.Request) -> web.Response:
+    spills: SpillStore = request.app['spills']
+    path = spills.get_path(request.match_info['name'])
+    if not path:
+        raise web.HTTPNotFound()
+    return web.FileResponse(path)
+
+
 def init_webapp(
-    get_index: Callable[[], str], ws_msg_handler: Callable[[Dict], None]
+    get_index: Callable[[], str],
+    ws_msg_handler: Callable[[Dict], None],
+    blobs: BlobStore = None,
+    spills: SpillStore = None,
 ) -> web.Application:
     app = web.Application()
     app['get_index'] = get_index
     app['ws_msg_handler'] = ws_msg_handler
+    app['blobs'] = blobs
+    app['spills'] = spills
     app['wss'] = WeakSet()
     app.router.add_static(
         '/static', resource_filename('knitj', 'client/static'), append_version=True
     )
     app.router.add_get('/', handler)
     app.router.add_get('/ws', handler)
+    if blobs:
+        app.router.add_get('/blob/{name}', blob_handler)
+    if spills:
+        app.router.add_get('/spill/{name}', spill_handler)
     app.on_shutdown.append(on_shutdown)
     return app
@@ -1,4 +1,5 @@
-from typing import Awaitable, Callable, AsyncIterable, List, Any
+from os import PathLike
+from typing import Awaitable, Callable, AsyncIterable, List, Any, Mapping, Dict
 
 from . import WSMessage, WSCloseCode
 
@@ -13,12 +14,19 @@ class BaseRequest:
 
 class Request(BaseRequest):
     app: 'Application'
+    match_info: Dict[str, str]
 
 
 class Response:
     def __init__(self, *, text: str = None, content_type: str = None) -> None: ...
 
 
+class FileResponse(Response):
+    def __init__(
+        self, path: PathLike, *, headers: Mapping[str, str] = None
+    ) -> None: ...
+
+
 Handler = Callable[[Request], Awaitable[Response]]
 
 
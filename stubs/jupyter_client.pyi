@@ -1,8 +1,26 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
+
+
+class Session:
+    def send(
+        self, stream: Any, msg_or_type: str, content: Dict[str, Any] = None
+    ) -> Dict[str, Any]: ...
+    def msg(self, msg_type: str, content: Dict[str, Any] = None) -> Dict[str, Any]: ...
+    def serialize(self, msg: Dict[str, Any]) -> List[bytes]: ...
+    def feed_identities(
+        self, msg_list: List[bytes]
+    ) -> Tuple[List[bytes], List[bytes]]: ...
+    def deserialize(self, msg_list: List[bytes]) -> Dict[str, Any]: ...
 
 
 class KernelClient:
-    def execute(self, code: str) -> str: ...
+    def execute(
+        self,
+        code: str,
+        silent: bool = False,
+        store_history: bool = True,
+        stop_on_error: bool = True,
+    ) -> str: ...
     def shutdown(self) -> str: ...
     def get_shell_msg(self, timeout: float = None) -> Dict[str, Any]: ...
     def get_iopub_msg(self, timeout: float = None) -> Dict[str, Any]: ...
@@ -10,9 +28,18 @@ class KernelClient:
 
 
 class KernelManager:
-    def __init__(self, kernel_name: str = None) -> None: ...
+    session: Session
+    has_kernel: bool
+    def __init__(
+        self, kernel_name: str = None, connection_file: str = None
+    ) -> None: ...
+    def load_connection_file(self) -> None: ...
     def start_kernel(self) -> None: ...
     def restart_kernel(self) -> None: ...
     def interrupt_kernel(self) -> None: ...
     def shutdown_kernel(self) -> None: ...
     def client(self) -> KernelClient: ...
+    def get_connection_info(self) -> Dict[str, Any]: ...
+
+
+def find_connection_file(filename: str = ...) -> str: ...
@@ -1,6 +1,8 @@
 from .lexers import Lexer
 from .formatters import Formatter
 
+__version__: str
+
 
 def highlight(code: str, lexer: Lexer, formatter: Formatter) -> str:
     ...
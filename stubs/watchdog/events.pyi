@@ -1,4 +1,7 @@
 class FileSystemEvent:
     src_path: str
 
+class FileSystemMovedEvent(FileSystemEvent):
+    dest_path: str
+
 class FileSystemEventHandler: ...
@@ -0,0 +1,12 @@
+SUB: int
+DEALER: int
+SUBSCRIBE: int
+
+class Socket:
+    def connect(self, addr: str) -> None: ...
+    def close(self, linger: int = None) -> None: ...
+
+class Context:
+    @classmethod
+    def instance(cls) -> Context: ...
+    def socket(self, socket_type: int) -> Socket: ...
@@ -1,5 +1,17 @@
-from typing import Any
+import asyncio
+from typing import Any, List
 
 class Poller:
     def register(self, socket: Any) -> None: ...
     async def poll(self) -> Any: ...
+
+class Socket:
+    def setsockopt(self, option: int, value: Any) -> None: ...
+    def connect(self, addr: str) -> None: ...
+    async def recv_multipart(self) -> List[bytes]: ...
+    def send_multipart(self, msg_parts: List[bytes]) -> asyncio.Future: ...
+
+class Context:
+    def __init__(self) -> None: ...
+    def socket(self, socket_type: int) -> Socket: ...
+    def destroy(self, linger: int = None) -> None: ...